@@ -0,0 +1,47 @@
+"""超大图片：文件头探测和带内存配额的预处理不能被 PIL 的解压炸弹保护拦下"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import wd14_tagger_app as app
+
+
+@pytest.fixture
+def huge_png(tmp_path, monkeypatch):
+    # 使用默认内存设置，不读取本机的 config.json
+    monkeypatch.setattr(app, 'CONFIG_FILE', str(tmp_path / 'config.json'))
+    path = tmp_path / 'huge.png'
+    Image.new('L', (15000, 15000), 128).save(path, compress_level=1)
+    return str(path)
+
+
+def test_probe_accepts_huge_png(huge_png):
+    info = app.probe_image(huge_png)
+    assert info.valid, info.error
+    assert info.pixels == 15000 * 15000
+
+
+def test_guarded_preprocess_uses_low_memory_path(huge_png):
+    image_array, note = app.preprocess_image_guarded(huge_png)
+    assert note == 'low_memory'
+    assert image_array.shape == (1, 448, 448, 3)
+    assert np.allclose(image_array, 128)
+
+
+def test_decode_over_budget_is_rejected(huge_png, tmp_path):
+    # PNG 无法降采样解码，uint8 解码结果（约 215 MB）超过配额时直接拒绝，而不是只记账后照常分配
+    (tmp_path / 'config.json').write_text('{"memory": {"budget_mb": 128}}', encoding='utf-8')
+    app._memory_budget = None
+    try:
+        image_array, note = app.preprocess_image_guarded(huge_png)
+    finally:
+        app._memory_budget = None
+    assert image_array is None
+    assert note == 'too_large'
+
+
+def test_upload_keeps_default_pixel_limit(huge_png):
+    with open(huge_png, 'rb') as f:
+        image_array, note = app.preprocess_image_guarded(f, max_pixels=app.API_UPLOAD_MAX_PIXELS)
+    assert image_array is None
+    assert note == 'too_large'
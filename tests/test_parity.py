@@ -0,0 +1,33 @@
+"""精度对比：用替身模型跑一遍命令行的对比流程，候选配置与参考配置一致时应当 PASS"""
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('onnx')
+
+import wd14_tagger_app as app
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'wd14_tagger_app.py')
+
+
+@pytest.mark.parametrize('channels_first, extra_args', [(False, []), (True, ['--threads', '1'])])
+def test_standin_parity_passes(tmp_path, channels_first, extra_args):
+    model_dir = tmp_path / 'standin'
+    app.build_standin_model(str(model_dir), channels_first=channels_first)
+    images = tmp_path / 'images'
+    images.mkdir()
+    rng = np.random.default_rng(0)
+    for i, size in enumerate([(640, 480), (300, 900), (512, 512)]):
+        Image.fromarray(rng.integers(0, 256, (*size[::-1], 3), dtype=np.uint8)).save(images / f'{i}.png')
+    
+    # 在临时目录中运行，不读取本机的 config.json
+    result = subprocess.run([sys.executable, APP, '--parity', '--input', str(images), '--model', str(model_dir),
+                             '--threshold', '0.5', '--batch-size', '2', *extra_args],
+                            cwd=tmp_path, capture_output=True, text=True, encoding='utf-8', timeout=300)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert result.stdout.strip().endswith('PASS')
+    assert '图片: 3，失败: 0' in result.stdout
@@ -0,0 +1,33 @@
+"""标签索引：画廊筛选直接按图片目录 id 分页，删除图片后不再出现在结果和统计中"""
+import wd14_tagger_app as app
+
+
+def build(count):
+    catalog, index = app.ImageCatalog(), app.TagIndex()
+    paths = [f'/data/{i}.png' for i in range(count)]
+    catalog.add(paths)
+    for i, path in enumerate(paths):
+        index.update(path, ['1girl', 'solo' if i % 2 else 'monochrome'], catalog.id_of(path))
+    return catalog, index, paths
+
+
+def test_filter_pages_over_catalog_ids():
+    catalog, index, paths = build(10)
+    ids = index.query_keys('1girl, -monochrome')
+    assert [item.path for item in catalog.page(0, 3, ids=ids)] == paths[1:7:2]
+    assert [item.path for item in catalog.page(3, 3, ids=ids)] == paths[7:10:2]
+
+
+def test_removed_images_leave_the_index():
+    catalog, index, paths = build(6)
+    catalog.remove([catalog.id_of(paths[1])])
+    index.remove([paths[1]])
+    assert len(index) == 5
+    assert [item.path for item in catalog.page(0, 10, ids=index.query_keys('solo'))] == [paths[3], paths[5]]
+    assert dict(index.frequencies())['solo'] == 2
+    assert len(index.query_keys('-solo')) == 3
+
+    index.clear()
+    assert len(index) == 0
+    assert index.frequencies() == []
+    assert len(index.query_keys('1girl')) == 0
@@ -4,15 +4,39 @@
 """
 
 import os
+import io
+import sys
 import json
+import time
+import queue
+import heapq
+import threading
+import secrets
+import tarfile
+import zipfile
+import posixpath
+import ntpath
+import sqlite3
+import hashlib
+import platform
+import ctypes
 import subprocess
 import asyncio
+import bisect
 import urllib.request
 import urllib.error
+from collections import deque
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import Client, Listener
 from pathlib import Path
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict, Tuple, Union, Callable, Iterable
 
-from nicegui import ui, app, run
+from fastapi import File, Form, HTTPException, UploadFile
+from pydantic import BaseModel
+
+from nicegui import ui, app, run, background_tasks
 from nicegui.events import UploadEventArguments
 
 import cv2
@@ -27,13 +51,221 @@ CONFIG_FILE = "./config.json"
 MODEL_DIR = "F:\优可WD14打标器\models"
 DEFAULT_PORT = 7960  # 默认端口
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+# 内存配额默认值（可在 config.json 的 memory 中修改）
+MEMORY_BUDGET_MB = 4096  # 所有预处理线程在途解码内存总配额
+LOW_MEMORY_THRESHOLD_MB = 2048  # 单张图片估算超过该值时走低内存路径（约 8000×8000 以上）
+LOW_MEMORY_MAX_SIDE = 2048  # 低内存路径先缩小到的最长边
+# PIL 默认拒绝打开超过约 1.8 亿像素的图片（解压炸弹保护），本地文件中的超大图片改由内存配额和低内存路径处理，
+# 超过该值 2 倍（约 46000×46000）或 uint8 解码结果超过内存总配额的图片仍然拒绝
+MAX_IMAGE_PIXELS = 1024 * 1024 * 1024
+API_UPLOAD_MAX_PIXELS = 2 * Image.MAX_IMAGE_PIXELS  # HTTP 上传的图片保持 PIL 默认的拒绝阈值
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+PREPROCESS_WORKERS = min(8, os.cpu_count() or 1)  # 每批并行预处理的线程数
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv', '.m4v')
+OUTPUT_MODES = ('flat', 'mirror', 'sidecar')  # txt 输出方式，见 get_txt_path
+RETAG_MODES = ('skip', 'overwrite', 'diff')  # 已有 txt 时的处理方式，见 TaggingOptions
+SCAN_WORKERS = min(16, (os.cpu_count() or 1) * 4)  # 遍历文件夹的并行线程数（以 IO 为主）
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# 视频抽帧配置
+VIDEO_SAMPLE_INTERVAL = 1.0  # interval 模式的抽帧间隔（秒）；scene 模式下为同一场景内的最长间隔
+VIDEO_SCENE_THRESHOLD = 0.4  # 颜色直方图差异超过该值视为场景切换
+VIDEO_DUPLICATE_DISTANCE = 6  # 与上一帧感知哈希的汉明距离不超过该值时视为重复帧
+VIDEO_CLIP_MIN_RATIO = 0.2  # 出现在至少该比例采样帧中的标签计入整段视频的标签
+
+# HTTP API 微批处理配置
+API_MAX_BATCH_SIZE = 8  # 单次推理最多合并的请求数
+API_MAX_WAIT_MS = 10  # 凑批最长等待时间（毫秒）
+API_MAX_QUEUE = 64  # 等待队列上限，超出后返回 429
+
+# ============ 图片目录 ============
+
+GALLERY_PAGE_SIZE = 100  # 画廊每页显示的图片数
+CATALOG_DB_FILE = 'catalog.db'
+CATALOG_STATUSES = ('pending', 'tagged', 'failed')
+
+
+class CatalogItem:
+    """目录中的一张图片，id 在删除其他图片后保持不变"""
+    __slots__ = ('id', 'path', 'status', 'result')
+    
+    def __init__(self, item_id: int, path: str, status: str = 'pending', result: str = ''):
+        self.id = item_id
+        self.path = path
+        self.status = status  # pending / tagged / failed
+        self.result = result  # 最近一次处理结果（txt 路径或错误信息）
+
+
+class ImageCatalog:
+    """已添加图片的目录：按路径 O(1) 查重，按添加顺序分页，可选持久化到 SQLite
+    
+    选中状态只保存在内存中；attach 之后增删和状态变化同步写入数据库，重启后可恢复。
+    """
+    def __init__(self):
+        self._items: Dict[int, CatalogItem] = {}
+        self._by_path: Dict[str, int] = {}
+        self._order: List[int] = []  # 按添加顺序排列的 id，删除时重建
+        self._next_id = 1
+        self.selected: set = set()  # 选中的图片 id
+        self._lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+    
+    def __len__(self) -> int:
+        return len(self._order)
+    
+    def __contains__(self, path: str) -> bool:
+        return path in self._by_path
+    
+    def _insert(self, item: CatalogItem):
+        self._items[item.id] = item
+        self._by_path[item.path] = item.id
+        self._order.append(item.id)
+        self._next_id = max(self._next_id, item.id + 1)
+    
+    def attach(self, db_path: str):
+        """打开 SQLite 数据库：载入已保存的图片，当前内存中的图片写入数据库"""
+        with self._lock:
+            db = sqlite3.connect(db_path, check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, '
+                       "status TEXT NOT NULL DEFAULT 'pending', result TEXT NOT NULL DEFAULT '')")
+            current = [self._items[item_id] for item_id in self._order]
+            self._items, self._by_path, self._order, self._next_id = {}, {}, [], 1
+            self.selected.clear()
+            for row in db.execute('SELECT id, path, status, result FROM images ORDER BY id'):
+                self._insert(CatalogItem(*row))
+            self._db = db
+            self.add(item.path for item in current)
+            self.set_statuses([(item.path, item.status, item.result) for item in current if item.status != 'pending'])
+    
+    def detach(self):
+        """关闭数据库，图片保留在内存中"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+    
+    def add(self, paths) -> int:
+        """添加图片（已存在的路径会被忽略），返回新增数量"""
+        with self._lock:
+            added = []
+            for path in paths:
+                if path not in self._by_path:
+                    item = CatalogItem(self._next_id, path)
+                    self._insert(item)
+                    added.append(item)
+            if self._db is not None and added:
+                with self._db:
+                    self._db.executemany('INSERT INTO images (id, path) VALUES (?, ?)',
+                                         [(item.id, item.path) for item in added])
+            return len(added)
+    
+    def remove(self, item_ids) -> int:
+        """按 id 删除图片，返回删除数量"""
+        with self._lock:
+            removed = [self._items.pop(item_id) for item_id in set(item_ids) if item_id in self._items]
+            if not removed:
+                return 0
+            for item in removed:
+                del self._by_path[item.path]
+                self.selected.discard(item.id)
+            self._order = [item_id for item_id in self._order if item_id in self._items]
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany('DELETE FROM images WHERE id = ?', [(item.id,) for item in removed])
+            return len(removed)
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._by_path.clear()
+            self._order.clear()
+            self.selected.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM images')
+    
+    def get(self, item_id: int) -> Optional[CatalogItem]:
+        return self._items.get(item_id)
+    
+    def id_of(self, path: str) -> Optional[int]:
+        return self._by_path.get(path)
+    
+    def set_statuses(self, updates: List[Tuple[str, str, str]]):
+        """批量更新 (路径, 状态, 结果)，不在目录中的路径会被忽略"""
+        with self._lock:
+            rows = []
+            for path, status, result in updates:
+                item_id = self._by_path.get(path)
+                if item_id is not None:
+                    item = self._items[item_id]
+                    item.status, item.result = status, result
+                    rows.append((status, result, item_id))
+            if self._db is not None and rows:
+                with self._db:
+                    self._db.executemany('UPDATE images SET status = ?, result = ? WHERE id = ?', rows)
+    
+    def _iter_items(self, status: Optional[str] = None, after: int = 0):
+        start = bisect.bisect_right(self._order, after) if after else 0
+        for i in range(start, len(self._order)):
+            item = self._items[self._order[i]]
+            if status is None or item.status == status:
+                yield item
+    
+    def page(self, offset: int, limit: int, status: Optional[str] = None,
+             ids: Optional[np.ndarray] = None, after: int = 0) -> List[CatalogItem]:
+        """按添加顺序取一页图片，可按状态过滤，或只在给定的升序 id 数组（如标签筛选结果）中分页
+        
+        id 按添加顺序递增，所以 ids 的顺序就是添加顺序，分页时只需查找当前页的图片；
+        after 表示只取 id 大于它的图片，打标任务用它从上一个窗口之后继续读取，不必每次从头扫描。
+        """
+        with self._lock:
+            if ids is not None:
+                return [self._items[item_id] for item_id in ids[offset:offset + limit].tolist() if item_id in self._items]
+            if status is None and not after:
+                return [self._items[item_id] for item_id in self._order[offset:offset + limit]]
+            return list(islice(self._iter_items(status, after), offset, offset + limit))
+    
+    def count(self, status: Optional[str] = None) -> int:
+        with self._lock:
+            if status is None:
+                return len(self._order)
+            return sum(1 for _ in self._iter_items(status))
+    
+    def paths(self, status: Optional[str] = None) -> List[str]:
+        """所有图片路径（按添加顺序），可按状态过滤"""
+        with self._lock:
+            return [item.path for item in self._iter_items(status)]
+    
+    def iter_paths(self, status: Optional[str] = None):
+        """逐个返回图片路径，不复制列表（遍历期间持有锁，不要在遍历中等待其他线程）"""
+        with self._lock:
+            for item in self._iter_items(status):
+                yield item.path
+    
+    def last_id(self) -> int:
+        """最近添加的图片 id，目录为空时为 0"""
+        with self._lock:
+            return self._order[-1] if self._order else 0
+    
+    def reset_statuses(self):
+        """把所有图片标记为待处理"""
+        with self._lock:
+            for item in self._items.values():
+                item.status, item.result = 'pending', ''
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("UPDATE images SET status = 'pending', result = ''")
+
+
 # 全局状态
 class AppState:
     def __init__(self):
-        self.image_paths: List[str] = []
-        self.selected_indices: set = set()
-        self.is_processing = False
-        self.model_sessions: Dict[str, ort.InferenceSession] = {}
+        self.catalog = ImageCatalog()  # 已添加的图片和选中状态
+        self.gallery_page = 1
+        self.gallery_filter = ''  # 画廊标签筛选条件，见 TagIndex
+        self.model_sessions: Dict[str, 'TaggerSession'] = {}
         self.tag_data: Dict[str, Tuple[List[str], List[str]]] = {}
         # 国际化相关 - 延迟加载语言设置
         self._current_lang = None  # 使用私有变量，通过属性延迟加载
@@ -93,6 +325,71 @@ class AppState:
                 'processing_in_progress': '正在处理中，请稍候...',
                 'final_result': '最终统计: 完成 {completed} 个, 跳过 {skipped} 个, 失败 {failed} 个',
                 'no_images': '暂无图片，请添加图片',
+                'ensemble_models': '集成模型（选择两个及以上时启用）',
+                'ensemble_weights': '权重 (weighted)',
+                'inference_server': '独立推理进程',
+                'inference_server_started': '独立推理进程已就绪',
+                'inference_server_failed': '独立推理进程启动失败，继续在本进程推理',
+                'video_sampling': '视频抽帧（场景切换 / 固定间隔）',
+                'video_interval': '间隔（秒）',
+                'memory_low_memory': '超大图片，已走低内存路径',
+                'memory_throttled': '等待内存配额后处理',
+                'memory_too_large': '图片解码所需内存超过配额，已拒绝',
+                'memory_throttled_summary': '内存限流: {count} 张',
+                'bucket_summary': '按尺寸分组的预处理速度（单线程）: {stats}',
+                'bucket_stat': '{bucket} {images} 张 {speed:.1f} 张/秒',
+                'output_profile': '输出规则',
+                'no_profile': '（不使用规则）',
+                'tag_filter': '🔍 按标签筛选',
+                'tag_stats': '📊 标签统计',
+                'tag_stats_summary': '已索引 {images} 张图片，高频标签：',
+                'rejected_files': '已跳过 {count} 个损坏或无法读取的文件: {names}',
+                'tag_folder': '📁 打标整个文件夹',
+                'select_folder': '选择文件夹',
+                'folder_scanning': '正在遍历并打标: {folder}',
+                'folder_scanned': '已从 {folder} 加入 {count} 个文件',
+                'output_mode': '输出方式',
+                'output_mode_flat': '全部放在输出目录',
+                'output_mode_mirror': '在输出目录中保留文件夹结构',
+                'output_mode_sidecar': '与图片放在同一目录',
+                'retag_mode': '已有 txt 时',
+                'retag_mode_skip': '跳过',
+                'retag_mode_overwrite': '重新打标并覆盖',
+                'retag_mode_diff': '重新打标，只改写标签有变化的文件',
+                'tag_diff_summary': '差异重新打标：改写 {changed} 个，未变化 {unchanged} 个\n新增标签: {added}\n删除标签: {removed}',
+                'catalog_persist': '保存图片列表（重启后恢复）',
+                'tune': '⚙️ 自动调优',
+                'tuning': '正在调优 {model}，请稍候...',
+                'tune_done': '调优完成：批大小 {batch_size}，预处理线程 {workers}，推理线程 {intra_op_threads}，{images_per_sec} 张/秒',
+                'tune_failed': '调优失败: {error}',
+                'tune_info': '本机调优：批大小 {batch_size} / 预处理线程 {workers} / 推理线程 {intra_op_threads}（{images_per_sec} 张/秒）',
+                'not_tuned': '本机尚未调优，使用默认设置',
+                'select_model_first': '请先选择模型',
+                'watch_folder': '👀 监视文件夹',
+                'watch_dirs_placeholder': '每行一个文件夹，新图片会自动打标',
+                'start_watch': '开始监视',
+                'stop_watch': '停止监视',
+                'watch_started': '开始监视 {count} 个文件夹（{mode}）',
+                'watch_polling': '轮询',
+                'watch_stopped': '已停止监视',
+                'watch_invalid_dirs': '请填写有效的文件夹: {dirs}',
+                'watch_status': '监视中，已自动加入 {count} 个文件',
+                'job_list': '📋 任务列表',
+                'no_jobs': '暂无任务',
+                'job_priority': '任务优先级（数值越大越先执行）',
+                'job_queued': '已加入任务队列: #{id}',
+                'job_cancelled': '任务 #{id} 已取消',
+                'job_summary': '#{id} [{status}] {model} {done}/{total} · {speed:.2f} 张/秒 · 优先级 {priority}',
+                'job_queued_status': '排队中',
+                'job_running': '运行中',
+                'job_paused': '已暂停',
+                'job_cancelled_status': '已取消',
+                'job_failed_status': '出错',
+                'job_failed': '任务 #{id} 出错已停止: {error}',
+                'job_completed': '已完成',
+                'pause': '暂停',
+                'resume': '继续',
+                'cancel': '取消',
             },
             'en': {
                 'app_title': 'Youkengi WD14 Tagger',
@@ -147,6 +444,71 @@ class AppState:
                 'processing_in_progress': 'Processing in progress, please wait...',
                 'final_result': 'Final result: {completed} completed, {skipped} skipped, {failed} failed',
                 'no_images': 'No images, please add images',
+                'ensemble_models': 'Ensemble models (enabled with two or more)',
+                'ensemble_weights': 'Weights (weighted)',
+                'inference_server': 'Separate inference process',
+                'inference_server_started': 'Inference process ready',
+                'inference_server_failed': 'Failed to start inference process, using in-process inference',
+                'video_sampling': 'Video sampling (scene change / fixed interval)',
+                'video_interval': 'Interval (s)',
+                'memory_low_memory': 'Oversized image, used low-memory path',
+                'memory_throttled': 'Waited for memory budget',
+                'memory_too_large': 'Decoding would exceed the memory budget, rejected',
+                'memory_throttled_summary': 'Memory throttled: {count} images',
+                'bucket_summary': 'Preprocess speed by size (per thread): {stats}',
+                'bucket_stat': '{bucket} {images} images {speed:.1f} img/s',
+                'output_profile': 'Output Profile',
+                'no_profile': '(no rules)',
+                'tag_filter': '🔍 Filter by tags',
+                'tag_stats': '📊 Tag statistics',
+                'tag_stats_summary': '{images} images indexed, top tags:',
+                'rejected_files': 'Skipped {count} corrupt or unreadable files: {names}',
+                'tag_folder': '📁 Tag Whole Folder',
+                'select_folder': 'Select Folder',
+                'folder_scanning': 'Scanning and tagging: {folder}',
+                'folder_scanned': 'Added {count} files from {folder}',
+                'output_mode': 'Output Layout',
+                'output_mode_flat': 'All in output folder',
+                'output_mode_mirror': 'Mirror folder structure in output folder',
+                'output_mode_sidecar': 'Next to each image',
+                'retag_mode': 'When a txt already exists',
+                'retag_mode_skip': 'Skip',
+                'retag_mode_overwrite': 'Retag and overwrite',
+                'retag_mode_diff': 'Retag, rewrite only files whose tags changed',
+                'tag_diff_summary': 'Diff retag: {changed} rewritten, {unchanged} unchanged\nAdded tags: {added}\nRemoved tags: {removed}',
+                'catalog_persist': 'Keep image list across restarts',
+                'tune': '⚙️ Autotune',
+                'tuning': 'Tuning {model}, please wait...',
+                'tune_done': 'Tuning done: batch {batch_size}, {workers} preprocess workers, {intra_op_threads} inference threads, {images_per_sec} img/s',
+                'tune_failed': 'Tuning failed: {error}',
+                'tune_info': 'Tuned on this machine: batch {batch_size} / {workers} workers / {intra_op_threads} threads ({images_per_sec} img/s)',
+                'not_tuned': 'Not tuned on this machine, using defaults',
+                'select_model_first': 'Please select a model first',
+                'watch_folder': '👀 Watch Folders',
+                'watch_dirs_placeholder': 'One folder per line, new images are tagged automatically',
+                'start_watch': 'Start Watching',
+                'stop_watch': 'Stop Watching',
+                'watch_started': 'Watching {count} folders ({mode})',
+                'watch_polling': 'polling',
+                'watch_stopped': 'Stopped watching',
+                'watch_invalid_dirs': 'Please enter valid folders: {dirs}',
+                'watch_status': 'Watching, {count} files queued automatically',
+                'job_list': '📋 Jobs',
+                'no_jobs': 'No jobs',
+                'job_priority': 'Job priority (higher runs first)',
+                'job_queued': 'Job queued: #{id}',
+                'job_cancelled': 'Job #{id} cancelled',
+                'job_summary': '#{id} [{status}] {model} {done}/{total} · {speed:.2f} img/s · priority {priority}',
+                'job_queued_status': 'Queued',
+                'job_running': 'Running',
+                'job_paused': 'Paused',
+                'job_cancelled_status': 'Cancelled',
+                'job_failed_status': 'Failed',
+                'job_failed': 'Job #{id} stopped with an error: {error}',
+                'job_completed': 'Completed',
+                'pause': 'Pause',
+                'resume': 'Resume',
+                'cancel': 'Cancel',
             }
         }
     
@@ -218,6 +580,34 @@ def set_output_dir(output_dir: str):
     save_config(config)
 
 
+def get_output_mode() -> str:
+    """获取 txt 输出方式（见 get_txt_path）"""
+    config = load_config()
+    mode = config.get('output_mode', 'flat')
+    return mode if mode in OUTPUT_MODES else 'flat'
+
+
+def set_output_mode(mode: str):
+    """设置 txt 输出方式"""
+    config = load_config()
+    config['output_mode'] = mode
+    save_config(config)
+
+
+def get_retag_mode() -> str:
+    """获取已有 txt 时的处理方式（见 TaggingOptions.retag_mode）"""
+    config = load_config()
+    mode = config.get('retag_mode', 'skip')
+    return mode if mode in RETAG_MODES else 'skip'
+
+
+def set_retag_mode(mode: str):
+    """设置已有 txt 时的处理方式"""
+    config = load_config()
+    config['retag_mode'] = mode
+    save_config(config)
+
+
 def get_threshold() -> float:
     """获取置信度阈值"""
     config = load_config()
@@ -231,6 +621,129 @@ def set_threshold(threshold: float):
     save_config(config)
 
 
+def get_output_profiles() -> Dict[str, dict]:
+    """获取所有输出规则（config.json 中的 output_profiles）"""
+    config = load_config()
+    return config.get('output_profiles', {})
+
+
+def get_output_profile(name: Optional[str]) -> Optional[dict]:
+    """按名称获取输出规则，未指定或不存在时返回 None（不应用规则）"""
+    if not name:
+        return None
+    return get_output_profiles().get(name)
+
+
+def get_last_profile() -> str:
+    """获取上次使用的输出规则"""
+    config = load_config()
+    return config.get('last_profile', '')
+
+
+def set_last_profile(profile: str):
+    """设置上次使用的输出规则"""
+    config = load_config()
+    config['last_profile'] = profile
+    save_config(config)
+
+
+def get_ensemble_settings() -> dict:
+    """获取集成模式设置：模型列表、合并方式和权重"""
+    config = load_config()
+    return config.get('ensemble', {'models': [], 'mode': 'mean', 'weights': []})
+
+
+def set_ensemble_settings(settings: dict):
+    """设置集成模式"""
+    config = load_config()
+    config['ensemble'] = settings
+    save_config(config)
+
+
+def get_inference_server_settings() -> dict:
+    """获取独立推理进程设置，首次使用时生成连接密钥"""
+    config = load_config()
+    settings = config.get('inference_server', {})
+    if not settings.get('authkey'):
+        settings = {'enabled': settings.get('enabled', False), 'port': settings.get('port', INFERENCE_SERVER_PORT),
+                    'authkey': secrets.token_hex(16)}
+        set_inference_server_settings(settings)
+    return settings
+
+
+def set_inference_server_settings(settings: dict):
+    """设置独立推理进程"""
+    config = load_config()
+    config['inference_server'] = settings
+    save_config(config)
+
+
+def get_memory_settings() -> dict:
+    """获取预处理内存配额设置"""
+    config = load_config()
+    settings = {'budget_mb': MEMORY_BUDGET_MB, 'low_memory_threshold_mb': LOW_MEMORY_THRESHOLD_MB,
+                'low_memory_max_side': LOW_MEMORY_MAX_SIDE}
+    settings.update(config.get('memory', {}))
+    return settings
+
+
+def get_video_settings() -> dict:
+    """获取视频抽帧设置"""
+    config = load_config()
+    settings = {'mode': 'scene', 'interval': VIDEO_SAMPLE_INTERVAL, 'scene_threshold': VIDEO_SCENE_THRESHOLD,
+                'duplicate_distance': VIDEO_DUPLICATE_DISTANCE}
+    settings.update(config.get('video', {}))
+    return settings
+
+
+def set_video_settings(settings: dict):
+    """设置视频抽帧参数"""
+    config = load_config()
+    config['video'] = settings
+    save_config(config)
+
+
+def get_catalog_settings() -> dict:
+    """获取图片列表持久化设置"""
+    config = load_config()
+    settings = {'persist': False, 'path': CATALOG_DB_FILE}
+    settings.update(config.get('catalog', {}))
+    return settings
+
+
+def get_watch_dirs() -> List[str]:
+    """获取监视的文件夹列表"""
+    config = load_config()
+    return config.get('watch_dirs', [])
+
+
+def set_watch_dirs(directories: List[str]):
+    """设置监视的文件夹列表"""
+    config = load_config()
+    config['watch_dirs'] = directories
+    save_config(config)
+
+
+def get_host_fingerprint() -> str:
+    """本机硬件指纹，调优结果只在相同硬件上复用"""
+    info = '|'.join([platform.node(), platform.machine(), platform.processor(),
+                     str(os.cpu_count()), ort.__version__])
+    return hashlib.sha1(info.encode()).hexdigest()[:12]
+
+
+def get_tuning(model_name: str) -> Optional[dict]:
+    """获取模型在本机的调优结果（见 autotune_model）"""
+    config = load_config()
+    return config.get('tuning', {}).get(f'{model_name}@{get_host_fingerprint()}')
+
+
+def set_tuning(model_name: str, result: dict):
+    """保存模型在本机的调优结果"""
+    config = load_config()
+    config.setdefault('tuning', {})[f'{model_name}@{get_host_fingerprint()}'] = result
+    save_config(config)
+
+
 def get_last_language() -> str:
     """获取上次使用的语言"""
     config = load_config()
@@ -343,10 +856,97 @@ def get_wd14_models() -> List[str]:
     return models if models else [DEFAULT_MODEL]
 
 
-def load_wd14_model(model_name: str) -> Tuple[Optional[ort.InferenceSession], Optional[Tuple[List[str], List[str]]]]:
-    """加载WD14tagger模型，如果不存在则自动下载"""
-    model_path = os.path.join(MODEL_DIR, model_name, "model.onnx")
-    tags_path = os.path.join(MODEL_DIR, model_name, "selected_tags.csv")
+def load_tag_data(tags_path: str) -> Tuple[List[str], List[str]]:
+    """读取 selected_tags.csv，返回 (general标签, character标签)"""
+    general_tags = []
+    character_tags = []
+    with open(tags_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('tag_id'):
+                parts = line.split(',')
+                if len(parts) >= 4:
+                    tag = parts[1].strip()
+                    category = int(parts[2])
+                    if category == 0:
+                        general_tags.append(tag)
+                    elif category == 4:
+                        character_tags.append(tag)
+    return general_tags, character_tags
+
+
+IO_BINDING_BATCH_SIZES = 4  # 每个线程为多少种批大小保留预分配的缓冲区
+
+
+class TaggerSession:
+    """封装 ONNX Runtime 会话：加载时读取一次输入输出信息，推理时使用 IO binding
+    
+    每个线程按批大小保留输入缓冲区和预分配的输出缓冲区，稳定运行时 session 调用不再分配内存。
+    run 返回的分数直接是输出缓冲区（零拷贝），在同一线程下一次以相同批大小调用 run 前有效。
+    """
+    def __init__(self, session: ort.InferenceSession):
+        self.session = session
+        input_meta = session.get_inputs()[0]
+        self.input_name = input_meta.name
+        # 模型要求 CHW 格式时调整通道顺序
+        self.channels_first = len(input_meta.shape) == 4 and input_meta.shape[1] == 3
+        self.output_names = [output.name for output in session.get_outputs()]
+        self._local = threading.local()
+    
+    def _buffers(self) -> dict:
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        return buffers
+    
+    def _bind(self, batch: np.ndarray, outputs: List[np.ndarray]):
+        """首次遇到某个批大小时，按实际输出形状创建绑定和缓冲区"""
+        buffers = self._buffers()
+        if len(buffers) >= IO_BINDING_BATCH_SIZES:
+            buffers.pop(next(iter(buffers)))
+        binding = self.session.io_binding()
+        input_buffer = None
+        if self.channels_first:
+            input_buffer = np.empty((batch.shape[0], batch.shape[3], batch.shape[1], batch.shape[2]), dtype=np.float32)
+            binding.bind_input(self.input_name, 'cpu', 0, np.float32, input_buffer.shape, input_buffer.ctypes.data)
+        output_buffers = [np.empty_like(output) for output in outputs]
+        for name, buffer in zip(self.output_names, output_buffers):
+            binding.bind_output(name, 'cpu', 0, buffer.dtype, buffer.shape, buffer.ctypes.data)
+        buffers[batch.shape[0]] = (binding, input_buffer, output_buffers)
+    
+    def run(self, batch: np.ndarray) -> List[np.ndarray]:
+        """对一个 NHWC float32 批次推理，返回各输出（零拷贝视图）"""
+        entry = self._buffers().get(batch.shape[0])
+        if entry is None:
+            outputs = self.session.run(None, {
+                self.input_name: batch.transpose(0, 3, 1, 2) if self.channels_first else batch})
+            self._bind(batch, outputs)
+            return outputs
+        
+        binding, input_buffer, output_buffers = entry
+        if input_buffer is not None:
+            np.copyto(input_buffer, batch.transpose(0, 3, 1, 2))  # NHWC -> NCHW，写入复用的输入缓冲区
+        else:
+            # NHWC 模型直接绑定调用方的数组，不做拷贝
+            batch = np.ascontiguousarray(batch, dtype=np.float32)
+            binding.bind_input(self.input_name, 'cpu', 0, np.float32, batch.shape, batch.ctypes.data)
+        self.session.run_with_iobinding(binding)
+        return output_buffers
+
+
+def get_model_dir(model_name: str) -> str:
+    """模型文件夹：优先使用 MODEL_DIR 下的同名文件夹，model_name 也可以是包含 model.onnx 的文件夹路径"""
+    model_dir = os.path.join(MODEL_DIR, model_name)
+    if not os.path.isdir(model_dir) and os.path.isfile(os.path.join(model_name, "model.onnx")):
+        return model_name
+    return model_dir
+
+
+def load_wd14_model(model_name: str, intra_op_threads: Optional[int] = None,
+                    ) -> Tuple[Optional[TaggerSession], Optional[Tuple[List[str], List[str]]]]:
+    """加载WD14tagger模型，如果不存在则自动下载；intra_op_threads 不指定时使用本机调优得到的推理线程数"""
+    model_path = os.path.join(get_model_dir(model_name), "model.onnx")
+    tags_path = os.path.join(get_model_dir(model_name), "selected_tags.csv")
     
     # 检查模型文件是否存在，不存在则尝试下载
     if not os.path.exists(model_path) or not os.path.exists(tags_path):
@@ -364,31 +964,42 @@ def load_wd14_model(model_name: str) -> Tuple[Optional[ort.InferenceSession], Op
         return None, None
     
     try:
-        # 加载模型
-        session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        # 加载模型，使用本机调优得到的线程数
+        session_options = ort.SessionOptions()
+        tuning = get_tuning(model_name)
+        if intra_op_threads:
+            session_options.intra_op_num_threads = intra_op_threads
+        elif tuning and tuning.get('intra_op_threads'):
+            session_options.intra_op_num_threads = tuning['intra_op_threads']
+        session = TaggerSession(ort.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider']))
         
         # 加载标签
-        general_tags = []
-        character_tags = []
-        with open(tags_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('tag_id'):
-                    parts = line.split(',')
-                    if len(parts) >= 4:
-                        tag = parts[1].strip()
-                        category = int(parts[2])
-                        if category == 0:
-                            general_tags.append(tag)
-                        elif category == 4:
-                            character_tags.append(tag)
-        
-        return session, (general_tags, character_tags)
+        return session, load_tag_data(tags_path)
     except Exception as e:
         print(f"加载模型失败: {e}")
         return None, None
 
 
+def pad_and_resize(image_array: np.ndarray, size: Tuple[int, int] = (448, 448)) -> np.ndarray:
+    """把 BGR float32 图像填充为白底正方形并缩放，返回带 batch 维度的数组"""
+    # 填充为正方形
+    h, w, _ = image_array.shape
+    size_max = max(h, w)
+    pad_x = size_max - w
+    pad_y = size_max - h
+    pad_l = pad_x // 2
+    pad_t = pad_y // 2
+    image_array = np.pad(image_array, ((pad_t, pad_y - pad_t), (pad_l, pad_x - pad_l), (0, 0)), 
+                       mode='constant', constant_values=255)
+    
+    # 调整大小
+    interp = cv2.INTER_AREA if size_max > size[0] else cv2.INTER_LANCZOS4
+    image_array = cv2.resize(image_array, size, interpolation=interp)
+    
+    # 添加batch维度
+    return np.expand_dims(image_array, axis=0)
+
+
 def preprocess_image(image_path: str, size: Tuple[int, int] = (448, 448)) -> np.ndarray:
     """预处理图片"""
     try:
@@ -397,78 +1008,451 @@ def preprocess_image(image_path: str, size: Tuple[int, int] = (448, 448)) -> np.
         # 转换为BGR格式（参考代码使用的格式）
         image_array = np.array(image, dtype=np.float32)
         image_array = image_array[:, :, ::-1]  # RGB -> BGR
+        return pad_and_resize(image_array, size)
+    except Exception as e:
+        print(f"预处理图片失败: {e}")
+        return None
+
+
+class MemoryBudget:
+    """全局在途解码内存配额，所有预处理线程共享
+    
+    超过总配额的单张图片会等到没有其他图片在途时独占执行。
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self._cond = threading.Condition()
+    
+    def acquire(self, cost: int) -> Tuple[int, bool]:
+        """申请配额，返回 (实际占用字节数, 是否发生等待)"""
+        cost = min(cost, self.capacity)
+        waited = False
+        with self._cond:
+            while self.in_flight + cost > self.capacity:
+                waited = True
+                self._cond.wait()
+            self.in_flight += cost
+        return cost, waited
+    
+    def release(self, cost: int):
+        with self._cond:
+            self.in_flight -= cost
+            self._cond.notify_all()
+
+
+_memory_budget: Optional[MemoryBudget] = None
+
+
+def get_memory_budget() -> MemoryBudget:
+    """按配置创建全局内存配额（首次使用时）"""
+    global _memory_budget
+    if _memory_budget is None:
+        _memory_budget = MemoryBudget(get_memory_settings()['budget_mb'] * 1024 * 1024)
+    return _memory_budget
+
+
+def estimate_decode_bytes(image_size: Tuple[int, int], mode: str) -> int:
+    """按文件头中的尺寸和模式估算 preprocess_image 的峰值内存（不解码）
+    解码结果 + RGB 转换 + float32 数组 + float32 正方形填充及缩放时的副本
+    """
+    w, h = image_size
+    bands = len(mode) if mode not in ('P', 'L', '1', 'I', 'F', 'I;16') else 1
+    size_max = max(w, h)
+    return w * h * (bands + 3 + 12) + size_max * size_max * 12 * 2
+
+
+def decoded_image_bytes(image: Image.Image) -> int:
+    """PIL 解码结果的内存占用（多通道图片在 PIL 内部按每像素 4 字节存放）"""
+    if image.mode in ('1', 'L', 'P'):
+        bytes_per_pixel = 1
+    elif image.mode.startswith('I;16'):
+        bytes_per_pixel = 2
+    else:
+        bytes_per_pixel = 4
+    return image.size[0] * image.size[1] * bytes_per_pixel
+
+
+def preprocess_image_guarded(image_path, size: Tuple[int, int] = (448, 448),
+                             max_pixels: Optional[int] = None) -> Tuple[Optional[np.ndarray], str]:
+    """带内存配额的预处理，常规路径的结果与 preprocess_image 一致
+    
+    先只读文件头估算解码内存，在全局配额内执行；估算超过低内存阈值的图片
+    先在 uint8 下缩小（JPEG 直接降采样解码）再进入常规流程，结果与 preprocess_image 略有差异。
+    uint8 解码结果本身超过内存总配额的图片（PNG 等无法降采样解码的格式）直接拒绝；
+    max_pixels 用于不可信的输入（如 HTTP 上传），超过时拒绝。
+    返回: (预处理结果, 限流说明)，限流说明为 '' / 'low_memory' / 'throttled' / 'too_large'
+    """
+    settings = get_memory_settings()
+    try:
+        image = Image.open(image_path)
+    except Exception as e:
+        print(f"预处理图片失败: {e}")
+        return None, ''
+    if max_pixels is not None and image.size[0] * image.size[1] > max_pixels:
+        print(f"预处理图片失败: 图片过大 {image.size[0]}x{image.size[1]}")
+        return None, 'too_large'
+    
+    budget = get_memory_budget()
+    note = ''
+    cost = estimate_decode_bytes(image.size, image.mode)
+    low_memory = cost > settings['low_memory_threshold_mb'] * 1024 * 1024
+    if low_memory:
+        note = 'low_memory'
+        max_side = settings['low_memory_max_side']
+        # JPEG 按 1/2、1/4、1/8 降采样解码，其他格式只需一份 uint8 解码结果
+        image.draft('RGB', (max_side, max_side))
+        decoded = decoded_image_bytes(image)
+        if decoded > budget.capacity:
+            # 配额只能排队等待，无法阻止超出配额的单次解码分配
+            print(f"[内存] 解码需要 {decoded / 1024 / 1024:.0f} MB，超过内存总配额，已拒绝: {image_path}")
+            return None, 'too_large'
+        cost = decoded + max_side * max_side * (3 + 12 * 3)
+    
+    reserved, waited = budget.acquire(cost)
+    if waited and not note:
+        note = 'throttled'
+    try:
+        if low_memory:
+            image.thumbnail((settings['low_memory_max_side'],) * 2, Image.Resampling.LANCZOS, reducing_gap=2.0)
+            print(f"[内存] 低内存路径: {image_path} -> {image.size[0]}x{image.size[1]}")
+        image_array = np.array(image.convert('RGB'), dtype=np.float32)
+        image_array = image_array[:, :, ::-1]  # RGB -> BGR
+        return pad_and_resize(image_array, size), note
+    except Exception as e:
+        print(f"预处理图片失败: {e}")
+        return None, note
+    finally:
+        budget.release(reserved)
+
+
+def preprocess_frame(frame: np.ndarray, size: Tuple[int, int] = (448, 448)) -> np.ndarray:
+    """预处理 cv2 读取的视频帧（已是 BGR 格式）"""
+    return pad_and_resize(frame.astype(np.float32), size)
+
+
+# ============ 图片信息 ============
+
+PROBE_WORKERS = min(16, (os.cpu_count() or 1) * 2)  # 读取文件头的线程数
+
+
+class ImageInfo:
+    """只读文件头得到的图片信息，error 不为空表示文件无法使用"""
+    __slots__ = ('width', 'height', 'mode', 'format', 'frames', 'error')
+    
+    def __init__(self, width: int = 0, height: int = 0, mode: str = '', format: str = '', frames: int = 1,
+                 error: str = ''):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.format = format
+        self.frames = frames
+        self.error = error
+    
+    @property
+    def valid(self) -> bool:
+        return not self.error
+    
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+def _has_complete_trailer(path: str, image_format: str) -> bool:
+    """检查文件结尾是否是标准的结束标记（不解码），结尾之后附加了数据的图片也会返回 False"""
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 64))
+        tail = f.read()
+    if image_format == 'JPEG':
+        return b'\xff\xd9' in tail
+    if image_format == 'PNG':
+        return tail[-8:-4] == b'IEND'
+    if image_format == 'GIF':
+        return tail.rstrip(b'\x00')[-1:] == b';'
+    if image_format == 'WEBP':
+        return int.from_bytes(head[4:8], 'little') + 8 <= size
+    if image_format == 'BMP':
+        return int.from_bytes(head[2:6], 'little') <= size
+    return True
+
+
+def _decodes_completely(path: str) -> bool:
+    """结尾检查不通过时实际解码一次确认（相机/动态照片常在 JPEG 结束标记后附加数据），
+    只有解码失败才视为截断；JPEG 按 1/8 降采样解码"""
+    try:
+        with Image.open(path) as image:
+            image.draft('RGB', (image.size[0] // 8 or 1, image.size[1] // 8 or 1))
+            image.load()
+        return True
+    except Exception:
+        return False
+
+
+_probe_cache: Dict[str, Tuple[Tuple[int, int], ImageInfo]] = {}  # 路径 -> ((修改时间, 大小), 信息)
+_probe_cache_lock = threading.Lock()
+_probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='wd14-probe')
+
+
+def probe_image(path: str) -> ImageInfo:
+    """只读文件头获取尺寸、色彩模式、帧数，并检查文件是否被截断，结果按路径和修改时间缓存
+    
+    视频和压缩包只检查文件是否可读。
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        return ImageInfo(error=str(e))
+    signature = (st.st_mtime_ns, st.st_size)
+    with _probe_cache_lock:
+        cached = _probe_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    
+    if is_video_file(path) or is_archive_file(path):
+        info = ImageInfo(error='' if st.st_size > 0 else 'empty file')
+    else:
+        try:
+            # Image.open 只解析文件头，不解码像素
+            with Image.open(path) as image:
+                info = ImageInfo(image.size[0], image.size[1], image.mode, image.format or '',
+                                 getattr(image, 'n_frames', 1))
+            if not _has_complete_trailer(path, info.format) and not _decodes_completely(path):
+                info.error = 'truncated'
+        except Exception as e:
+            info = ImageInfo(error=str(e) or type(e).__name__)
+    with _probe_cache_lock:
+        _probe_cache[path] = (signature, info)
+    return info
+
+
+def cached_image_info(path: str) -> Optional[ImageInfo]:
+    """已缓存的图片信息（不访问磁盘），没有缓存时返回 None"""
+    with _probe_cache_lock:
+        cached = _probe_cache.get(path)
+    return cached[1] if cached else None
+
+
+def filter_valid_images(paths: List[str]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """在线程池中并行探测，返回 (可用的路径, [(无法使用的路径, 原因)])"""
+    valid, rejected = [], []
+    for path, info in zip(paths, _probe_pool.map(probe_image, paths)):
+        if info.valid:
+            valid.append(path)
+        else:
+            rejected.append((path, info.error))
+    return valid, rejected
+
+
+_model_cache_lock = threading.Lock()
+
+
+def get_cached_model(model_name: str) -> Tuple[Optional[TaggerSession], Optional[Tuple[List[str], List[str]]]]:
+    """获取已加载的模型，首次使用时加载并缓存到 state.model_sessions"""
+    with _model_cache_lock:
+        if model_name not in state.model_sessions:
+            session, tag_data = load_wd14_model(model_name)
+            if not session or not tag_data:
+                return None, None
+            state.model_sessions[model_name] = session
+            state.tag_data[model_name] = tag_data
+        return state.model_sessions[model_name], state.tag_data[model_name]
+
+
+def get_cached_tag_data(model_name: str) -> Tuple[List[str], List[str]]:
+    """只读取模型的标签表（不加载模型），供独立推理进程模式下的界面进程使用"""
+    with _model_cache_lock:
+        if model_name not in state.tag_data:
+            state.tag_data[model_name] = load_tag_data(os.path.join(get_model_dir(model_name), "selected_tags.csv"))
+        return state.tag_data[model_name]
+
+
+def run_tagger_batch(session: TaggerSession, batch: np.ndarray, copy: bool = False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """对一个 NHWC 批次执行推理，返回 (general输出, character输出)
+    
+    默认返回 TaggerSession 输出缓冲区的零拷贝视图；结果要交给其他线程使用时传入 copy=True
+    """
+    outputs = session.run(batch)
+    if copy:
+        outputs = [output.copy() for output in outputs]
+    character_output = outputs[1] if len(outputs) > 1 else None
+    return outputs[0], character_output
+
+
+def scores_to_tags(general_output: np.ndarray, character_output: Optional[np.ndarray],
+                   tag_data: Tuple[List[str], List[str]], threshold: float,
+                   rules: Optional['CompiledTagRules'] = None) -> List[Tuple[str, float]]:
+    """将单张图片的输出分数转换为 (标签, 分数) 列表，传入 rules 时在分数向量上应用标签规则"""
+    general_tags, character_tags = tag_data
+    # 跳过前4个评分标签（参考代码中的处理方式）
+    start_idx = 4
+    general_scores = general_output[start_idx:start_idx + len(general_tags)]
+    character_scores = character_output[:len(character_tags)] if character_output is not None else None
+    
+    if rules is not None:
+        if character_scores is not None and len(general_scores) == len(general_tags):
+            return rules.apply(np.concatenate([general_scores, character_scores]), threshold)
+        return rules.apply(general_scores, threshold)
+    
+    tags = [(general_tags[i], float(general_scores[i])) for i in np.flatnonzero(general_scores >= threshold)]
+    if character_scores is not None:
+        tags.extend((character_tags[i], float(character_scores[i])) for i in np.flatnonzero(character_scores >= threshold))
+    return tags
+
+
+# ============ 标签规则 ============
+
+class CompiledTagRules:
+    """按模型词表编译好的输出规则，对每张图片只做几次数组运算
+    
+    规则（对应 config.json 中 output_profiles 的一项）：
+    - blacklist: 删除的标签
+    - replacements: 同义词映射 {原标签: 新标签}，多个标签映射到同一标签时取最高分
+    - prepend: 强制放在最前面的触发词
+    - underscore: False 时把下划线替换为空格
+    - max_tags: 最多保留的标签数（不含触发词）
+    - order: 'score' 按分数从高到低，'model' 保持模型词表顺序
+    """
+    def __init__(self, profile: dict, vocabulary: List[str]):
+        index = {tag: i for i, tag in enumerate(vocabulary)}
+        normalize = lambda tag: tag.strip().replace(' ', '_')
         
-        # 填充为正方形
-        h, w, _ = image_array.shape
-        size_max = max(h, w)
-        pad_x = size_max - w
-        pad_y = size_max - h
-        pad_l = pad_x // 2
-        pad_t = pad_y // 2
-        image_array = np.pad(image_array, ((pad_t, pad_y - pad_t), (pad_l, pad_x - pad_l), (0, 0)), 
-                           mode='constant', constant_values=255)
+        names = list(vocabulary)
+        self.keep = np.ones(len(vocabulary), dtype=bool)
+        for tag in profile.get('blacklist', []):
+            if normalize(tag) in index:
+                self.keep[index[normalize(tag)]] = False
         
-        # 调整大小
-        interp = cv2.INTER_AREA if size_max > size[0] else cv2.INTER_LANCZOS4
-        image_array = cv2.resize(image_array, size, interpolation=interp)
+        # 映射表：原标签位置 -> 输出位置，词表外的新标签追加在词表之后
+        self.target = np.arange(len(vocabulary))
+        for source, replacement in profile.get('replacements', {}).items():
+            source, replacement = normalize(source), normalize(replacement)
+            if source not in index:
+                continue
+            if replacement not in index:
+                index[replacement] = len(names)
+                names.append(replacement)
+            self.target[index[source]] = index[replacement]
         
-        # 添加batch维度
-        image_array = np.expand_dims(image_array, axis=0)
-        return image_array
-    except Exception as e:
-        print(f"预处理图片失败: {e}")
+        underscore = profile.get('underscore', True)
+        self.display = [name if underscore else name.replace('_', ' ') for name in names]
+        self.prepend = [tag if underscore else tag.replace('_', ' ') for tag in map(normalize, profile.get('prepend', []))]
+        self.max_tags = profile.get('max_tags') or None
+        self.order = profile.get('order', 'model')
+        self._size = len(names)
+    
+    def apply(self, scores: np.ndarray, threshold: float) -> List[Tuple[str, float]]:
+        n = len(scores)
+        hits = np.flatnonzero((scores >= threshold) & self.keep[:n])
+        # 同义词合并：每个输出位置取映射到它的最高分
+        merged = np.full(self._size, -1.0, dtype=np.float32)
+        np.maximum.at(merged, self.target[hits], scores[hits])
+        selected = np.flatnonzero(merged >= 0)
+        if self.order == 'score':
+            selected = selected[np.argsort(-merged[selected], kind='stable')]
+        if self.max_tags:
+            if self.order != 'score':
+                # 先按分数截取，再恢复原有顺序
+                selected = np.sort(selected[np.argsort(-merged[selected], kind='stable')[:self.max_tags]])
+            else:
+                selected = selected[:self.max_tags]
+        
+        tags = [(tag, 1.0) for tag in self.prepend]
+        tags.extend((self.display[i], float(merged[i])) for i in selected if self.display[i] not in self.prepend)
+        return tags
+
+
+_compiled_rules_cache: Dict[Tuple[str, int], CompiledTagRules] = {}
+
+
+def compile_tag_rules(profile: Optional[dict], tag_data: Tuple[List[str], List[str]]) -> Optional[CompiledTagRules]:
+    """编译输出规则，按 (规则内容, 词表) 缓存，同一任务内只编译一次"""
+    if not profile:
         return None
+    key = (json.dumps(profile, sort_keys=True, ensure_ascii=False), id(tag_data))
+    rules = _compiled_rules_cache.get(key)
+    if rules is None:
+        rules = CompiledTagRules(profile, tag_data[0] + tag_data[1])
+        _compiled_rules_cache[key] = rules
+    return rules
+
 
+ENSEMBLE_MODES = ('mean', 'max', 'weighted')
+ENSEMBLE_PARALLEL_MIN_CORES = 4  # CPU 核数不少于此值时多个模型并发推理
+_ensemble_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='wd14-ensemble')
 
-def get_image_tags(image_path: str, model_name: str, threshold: float = 0.35) -> Tuple[str, str]:
-    """获取图片标签"""
-    # 每次都重新加载模型，确保使用正确的模型
-    session, tag_data = load_wd14_model(model_name)
+
+def combine_scores(outputs: List[np.ndarray], mode: str = 'mean', weights: Optional[List[float]] = None) -> np.ndarray:
+    """合并多个模型对同一批图片的输出分数（阈值过滤之前）"""
+    stacked = np.stack(outputs)
+    if mode == 'max':
+        return stacked.max(axis=0)
+    if mode == 'weighted' and weights and len(weights) == len(outputs):
+        w = np.asarray(weights, dtype=np.float32)
+        return np.tensordot(w / w.sum(), stacked, axes=1)
+    return stacked.mean(axis=0)
+
+
+def infer_tag_scores(model: Union[str, List[str]], batch: np.ndarray, ensemble_mode: str = 'mean',
+                     ensemble_weights: Optional[List[float]] = None
+                     ) -> Tuple[np.ndarray, Optional[np.ndarray], Tuple[List[str], List[str]]]:
+    """对预处理好的批次推理，返回 (general输出, character输出, 标签数据)
+    
+    传入多个模型名称时为集成模式：同一个预处理张量送入每个已加载的模型，
+    按 mean / max / weighted 合并分数，第二个模型只增加推理开销。
+    单模型时返回的分数是输出缓冲区的视图，见 TaggerSession。
+    """
+    model_names = [model] if isinstance(model, str) else list(model)
+    loaded = [get_cached_model(name) for name in model_names]
+    if any(not session or not tag_data for session, tag_data in loaded):
+        raise RuntimeError("模型加载失败")
+    if len(loaded) == 1:
+        session, tag_data = loaded[0]
+        return (*run_tagger_batch(session, batch), tag_data)
+    
+    tag_data = loaded[0][1]
+    if any(other != tag_data for _, other in loaded[1:]):
+        raise ValueError("集成模式要求所有模型使用相同的标签表 (selected_tags.csv)")
+    
+    # 推理时 ONNX Runtime 会释放 GIL，核数足够时多个模型并发执行
+    # 线程池中的输出缓冲区可能被下一个任务复用，因此复制一份
+    if (os.cpu_count() or 1) >= ENSEMBLE_PARALLEL_MIN_CORES:
+        outputs = list(_ensemble_pool.map(lambda item: run_tagger_batch(item[0], batch, copy=True), loaded))
+    else:
+        outputs = [run_tagger_batch(session, batch) for session, _ in loaded]
+    
+    general_output = combine_scores([g for g, _ in outputs], ensemble_mode, ensemble_weights)
+    character_output = None
+    if all(c is not None for _, c in outputs):
+        character_output = combine_scores([c for _, c in outputs], ensemble_mode, ensemble_weights)
+    return general_output, character_output, tag_data
+
+
+def get_image_tags(image_path: str, model_name: str, threshold: float = 0.35,
+                   profile: Optional[str] = None) -> Tuple[str, str]:
+    """获取图片标签，profile 为输出规则名称（见 CompiledTagRules）"""
+    session, tag_data = get_cached_model(model_name)
     if not session or not tag_data:
         return "Error: 模型加载失败", ""
     
-    general_tags, character_tags = tag_data
-    
     # 预处理图片
     image_array = preprocess_image(image_path)
     if image_array is None:
         return "Error: 图片预处理失败", ""
     
     try:
-        # 推理
-        input_name = session.get_inputs()[0].name
-        
-        # 确保输入形状正确
-        if image_array.shape != tuple(session.get_inputs()[0].shape):
-            if len(session.get_inputs()[0].shape) == 4:
-                # 检查是否需要调整通道顺序
-                if session.get_inputs()[0].shape[1] == 3:  # CHW format
-                    image_array = image_array.transpose(0, 3, 1, 2)  # NHWC -> NCHW
-        
         # 执行推理
-        outputs = session.run(None, {input_name: image_array})
-        
-        # 处理输出
-        general_output = outputs[0][0]
-        character_output = outputs[1][0] if len(outputs) > 1 else []
+        general_output, character_output = run_tagger_batch(session, image_array)
         
         # 过滤标签
-        tags = []
-        # 跳过前4个评分标签（参考代码中的处理方式）
-        start_idx = 4
-        
-        for i in range(start_idx, len(general_output)):
-            score = general_output[i]
-            if score >= threshold and i - start_idx < len(general_tags):
-                tag = general_tags[i - start_idx]
-                tags.append(tag)
-        
-        for i, score in enumerate(character_output):
-            if score >= threshold and i < len(character_tags):
-                tags.append(character_tags[i])
+        tags = scores_to_tags(general_output[0],
+                              character_output[0] if character_output is not None else None,
+                              tag_data, threshold, compile_tag_rules(get_output_profile(profile), tag_data))
         
         # 生成英文标签（使用下划线格式）
-        english_tags = ", ".join(tags)
+        english_tags = ", ".join(tag for tag, _ in tags)
         
         return english_tags, ""
     except Exception as e:
@@ -476,17 +1460,35 @@ def get_image_tags(image_path: str, model_name: str, threshold: float = 0.35) ->
         return f"Error: {str(e)}", ""
 
 
-def save_tags_to_txt(image_path: str, english_tags: str, chinese_description: str, output_dir: str) -> tuple[bool, str]:
-    """保存标签到 txt 文件"""
+def get_txt_path(image_path: str, output_dir: str, output_mode: str = 'flat', input_root: Optional[str] = None) -> str:
+    """图片对应的 txt 输出路径
+    
+    output_mode: flat 按文件名放在输出目录下；mirror 在输出目录下复刻 input_root 之下的目录结构
+    （不在 input_root 之下的图片按 flat 处理）；sidecar 与图片放在同一目录。
+    """
+    stem = os.path.splitext(image_path)[0]
+    if output_mode == 'sidecar':
+        return stem + ".txt"
+    if output_mode == 'mirror' and input_root:
+        try:
+            relative = os.path.relpath(os.path.abspath(stem), os.path.abspath(input_root))
+        except ValueError:  # Windows 下不同盘符
+            relative = os.pardir
+        if not relative.startswith(os.pardir):
+            return os.path.join(output_dir, relative + ".txt")
+    return os.path.join(output_dir, os.path.basename(stem) + ".txt")
+
+
+def save_tags_to_txt(image_path: str, english_tags: str, chinese_description: str, output_dir: str,
+                     output_mode: str = 'flat', input_root: Optional[str] = None) -> tuple[bool, str]:
+    """保存标签到 txt 文件，输出方式见 get_txt_path"""
     if not english_tags or english_tags.startswith("Error:"):
         return False, "标签无效或为空"
     
-    image_name = os.path.basename(image_path)
-    txt_name = os.path.splitext(image_name)[0] + ".txt"
-    txt_path = os.path.join(output_dir, txt_name)
+    txt_path = get_txt_path(image_path, output_dir, output_mode, input_root)
     
     try:
-        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(txt_path) or '.', exist_ok=True)
         with open(txt_path, "w", encoding="utf-8") as f:
             # 只写入英文标签
             f.write(english_tags.strip())
@@ -529,8 +1531,7 @@ def update_language():
         if current_text == '等待开始处理...':
             state.ui_refs['progress_info'].set_value(state.t('waiting_for_processing'))
     if 'status_label' in state.ui_refs:
-        state.ui_refs['status_label'].set_text(state.t('files_uploaded', 
-            count=len(state.image_paths), selected=len(state.selected_indices)))
+        update_status_label()
     
     # 更新右侧面板
     if 'image_upload_label' in state.ui_refs:
@@ -560,6 +1561,50 @@ def update_language():
         state.ui_refs['open_output_folder_button'].set_text(state.t('open_output_folder'))
     if 'start_processing_button' in state.ui_refs:
         state.ui_refs['start_processing_button'].set_text(state.t('start_processing'))
+    if 'ensemble_models_label' in state.ui_refs:
+        state.ui_refs['ensemble_models_label'].set_text(state.t('ensemble_models'))
+    if 'ensemble_weights_input' in state.ui_refs:
+        state.ui_refs['ensemble_weights_input'].props(f'label="{state.t("ensemble_weights")}"')
+    if 'tag_filter_input' in state.ui_refs:
+        state.ui_refs['tag_filter_input'].props(f'label="{state.t("tag_filter")}"')
+    if 'tag_stats_expansion' in state.ui_refs:
+        state.ui_refs['tag_stats_expansion'].set_text(state.t('tag_stats'))
+    update_tag_stats()
+    if 'output_profile_label' in state.ui_refs:
+        state.ui_refs['output_profile_label'].set_text(state.t('output_profile'))
+    if 'video_sampling_label' in state.ui_refs:
+        state.ui_refs['video_sampling_label'].set_text(state.t('video_sampling'))
+    if 'video_interval_input' in state.ui_refs:
+        state.ui_refs['video_interval_input'].props(f'label="{state.t("video_interval")}"')
+    if 'inference_server_switch' in state.ui_refs:
+        state.ui_refs['inference_server_switch'].set_text(state.t('inference_server'))
+    if 'tag_folder_button' in state.ui_refs:
+        state.ui_refs['tag_folder_button'].set_text(state.t('tag_folder'))
+    if 'output_mode_select' in state.ui_refs:
+        select = state.ui_refs['output_mode_select']
+        select.options = {mode: state.t('output_mode_' + mode) for mode in OUTPUT_MODES}
+        select.props(f'label="{state.t("output_mode")}"')
+        select.update()
+    if 'retag_mode_select' in state.ui_refs:
+        select = state.ui_refs['retag_mode_select']
+        select.options = {mode: state.t('retag_mode_' + mode) for mode in RETAG_MODES}
+        select.props(f'label="{state.t("retag_mode")}"')
+        select.update()
+    if 'catalog_persist_switch' in state.ui_refs:
+        state.ui_refs['catalog_persist_switch'].set_text(state.t('catalog_persist'))
+    if 'tune_button' in state.ui_refs:
+        state.ui_refs['tune_button'].set_text(state.t('tune'))
+    update_tuning_label()
+    if 'watch_folder_label' in state.ui_refs:
+        state.ui_refs['watch_folder_label'].set_text(state.t('watch_folder'))
+    if 'watch_input' in state.ui_refs:
+        state.ui_refs['watch_input'].props(f'placeholder="{state.t("watch_dirs_placeholder")}"')
+    update_watch_status()
+    if 'job_list_label' in state.ui_refs:
+        state.ui_refs['job_list_label'].set_text(state.t('job_list'))
+    if 'job_priority_label' in state.ui_refs:
+        state.ui_refs['job_priority_label'].set_text(state.t('job_priority'))
+    update_job_list()
 
 
 def open_output_folder(output_dir: str):
@@ -610,18 +1655,43 @@ def create_left_panel():
     # 画廊标题
     state.ui_refs['uploaded_images_label'] = ui.label(state.t('uploaded_images')).classes('text-lg font-semibold mb-3')
     
+    # 标签筛选（基于打标结果的倒排索引）
+    def on_filter_change(e):
+        state.gallery_filter = (e.value or '').strip()
+        update_gallery()
+    
+    state.ui_refs['tag_filter_input'] = ui.input(
+        label=state.t('tag_filter'),
+        placeholder='1girl, -monochrome, red_hair | blue_hair',
+        on_change=on_filter_change
+    ).props('clearable debounce=300').classes('w-full mb-2')
+    with ui.expansion(state.t('tag_stats')).classes('w-full mb-2') as tag_stats_expansion:
+        state.ui_refs['tag_stats_label'] = ui.label('').classes('text-xs text-gray-600 whitespace-pre-wrap')
+    state.ui_refs['tag_stats_expansion'] = tag_stats_expansion
+    update_tag_stats()
+    
     # 画廊网格容器 - 使用卡片样式
     with ui.card().classes('w-full p-4 min-h-[400px]'):
         # 画廊网格 - 使用响应式列数，图片保持完整显示
         gallery_grid = ui.element('div').classes('w-full grid gap-3')
         gallery_grid.style('grid-template-columns: repeat(auto-fill, minmax(200px, 1fr))')
         
+        # 分页
+        def on_page_change(e):
+            if e.value == state.gallery_page:
+                return
+            state.gallery_page = e.value
+            update_gallery()
+        
+        state.ui_refs['gallery_pagination'] = ui.pagination(1, 1, direction_links=True, value=state.gallery_page,
+                                                            on_change=on_page_change).classes('mt-3')
+        
         # 显示画廊内容
         with gallery_grid:
             update_gallery()
     
     # 图片状态
-    status_label = ui.label(state.t('files_uploaded', count=len(state.image_paths), selected=len(state.selected_indices))).classes('text-sm text-gray-500 mt-3')
+    status_label = ui.label(state.t('files_uploaded', count=len(state.catalog), selected=len(state.catalog.selected))).classes('text-sm text-gray-500 mt-3')
     state.ui_refs['status_label'] = status_label
     
     # 打标处理进度信息框
@@ -632,6 +1702,13 @@ def create_left_panel():
             placeholder=state.t('waiting_for_processing')
         ).props('readonly filled').classes('w-full').style('min-height: 120px; font-family: monospace; background: white;')
     state.ui_refs['progress_info'] = progress_info
+    
+    # 任务列表
+    global job_list
+    with ui.card().classes('w-full p-4 mt-3'):
+        state.ui_refs['job_list_label'] = ui.label(state.t('job_list')).classes('text-lg font-semibold mb-2')
+        job_list = ui.column().classes('w-full gap-1')
+    update_job_list()
 
 
 def create_right_panel():
@@ -642,7 +1719,7 @@ def create_right_panel():
             state.ui_refs['image_upload_label'] = ui.label(state.t('image_upload')).classes('text-lg font-semibold mb-3')
             
             # 添加图片按钮 - 使用本地文件选择器
-            def open_file_dialog():
+            async def open_file_dialog():
                 """打开文件选择对话框"""
                 from nicegui import native
                 import tkinter as tk
@@ -654,14 +1731,16 @@ def create_right_panel():
                 
                 files = filedialog.askopenfilenames(
                     title=state.t('select_images'),
-                    filetypes=[('图片文件', '*.jpg *.jpeg *.png *.gif *.bmp *.webp')]
+                    filetypes=[('图片文件', '*.jpg *.jpeg *.png *.gif *.bmp *.webp'),
+                               ('视频文件', ' '.join('*' + ext for ext in VIDEO_EXTENSIONS)),
+                               ('压缩包', ' '.join('*' + ext for ext in ARCHIVE_EXTENSIONS))]
                 )
                 root.destroy()
                 
                 if files:
-                    for file_path in files:
-                        if file_path not in state.image_paths:
-                            state.image_paths.append(file_path)
+                    files, rejected = await run.io_bound(filter_valid_images, list(files))
+                    notify_rejected(rejected)
+                    state.catalog.add(files)
                     # 先清除再重新添加，确保更新
                     gallery_grid.clear()
                     update_gallery()
@@ -669,14 +1748,33 @@ def create_right_panel():
                     ui.notify(state.t('added_images', count=len(files)), type='positive')
             
             state.ui_refs['add_images_button'] = ui.button(state.t('add_images'), on_click=open_file_dialog).classes('w-full mb-2 bg-blue-500 text-white')
-        
-        # 图片管理
+            
+            # 打标整个文件夹 - 包括子文件夹，边遍历边打标
+            async def open_folder_dialog():
+                import tkinter as tk
+                from tkinter import filedialog
+                
+                root = tk.Tk()
+                root.withdraw()
+                root.attributes('-topmost', True)
+                folder = filedialog.askdirectory(title=state.t('select_folder'))
+                root.destroy()
+                if folder:
+                    await tag_folder(folder)
+            
+            state.ui_refs['tag_folder_button'] = ui.button(state.t('tag_folder'), on_click=open_folder_dialog).classes('w-full mb-2 bg-blue-100 text-gray-700')
+        
+        # 图片管理
         with ui.card().classes('w-full p-4'):
             state.ui_refs['image_management_label'] = ui.label(state.t('image_management')).classes('text-lg font-semibold mb-3')
             
             with ui.row().classes('w-full gap-2'):
                 state.ui_refs['delete_selected_button'] = ui.button(state.t('delete_selected'), on_click=delete_selected).classes('flex-1 bg-gray-200 text-gray-700')
                 state.ui_refs['clear_all_button'] = ui.button(state.t('clear_all'), on_click=clear_all).classes('flex-1 bg-gray-200 text-gray-700')
+            state.ui_refs['catalog_persist_switch'] = ui.switch(
+                state.t('catalog_persist'), value=get_catalog_settings()['persist'],
+                on_change=lambda e: set_catalog_persist(e.value)
+            ).classes('mt-2')
         
         # 设置区域
         with ui.card().classes('w-full p-4'):
@@ -693,11 +1791,52 @@ def create_right_panel():
             model_select = ui.select(
                 options=models,
                 value=last_model,
-                on_change=lambda e: set_last_model(e.value)
+                on_change=lambda e: (set_last_model(e.value), update_tuning_label())
             ).classes('w-full mb-3')
             
             state.ui_refs['refresh_models_button'] = ui.button(state.t('refresh_models'), on_click=refresh_models).classes('w-full bg-gray-100 text-gray-700 mb-3')
             
+            # 自动调优
+            state.ui_refs['tune_button'] = ui.button(state.t('tune'), on_click=run_autotune).classes('w-full bg-gray-100 text-gray-700 mb-1')
+            state.ui_refs['tuning_label'] = ui.label('').classes('text-xs text-gray-500 mb-3')
+            update_tuning_label()
+            
+            # 视频抽帧方式
+            video = get_video_settings()
+            state.ui_refs['video_sampling_label'] = ui.label(state.t('video_sampling')).classes('text-sm text-gray-600 mb-1')
+            with ui.row().classes('w-full gap-2 mb-3 no-wrap'):
+                ui.select(
+                    options=['scene', 'interval'],
+                    value=video['mode'],
+                    on_change=lambda e: set_video_settings({**get_video_settings(), 'mode': e.value})
+                ).classes('flex-1')
+                state.ui_refs['video_interval_input'] = ui.number(
+                    label=state.t('video_interval'), value=video['interval'], min=0.1, step=0.5,
+                    on_change=lambda e: set_video_settings({**get_video_settings(), 'interval': float(e.value or VIDEO_SAMPLE_INTERVAL)})
+                ).classes('flex-1')
+            
+            # 集成模式：多个模型共用一次预处理
+            global ensemble_select
+            ensemble = get_ensemble_settings()
+            state.ui_refs['ensemble_models_label'] = ui.label(state.t('ensemble_models')).classes('text-sm text-gray-600 mb-1')
+            ensemble_select = ui.select(
+                options=models,
+                value=[m for m in ensemble.get('models', []) if m in models],
+                multiple=True,
+                on_change=lambda e: update_ensemble_settings(models=list(e.value or []))
+            ).classes('w-full mb-2').props('use-chips')
+            with ui.row().classes('w-full gap-2 mb-3 no-wrap'):
+                ui.select(
+                    options=list(ENSEMBLE_MODES),
+                    value=ensemble.get('mode', 'mean'),
+                    on_change=lambda e: update_ensemble_settings(mode=e.value)
+                ).classes('flex-1')
+                state.ui_refs['ensemble_weights_input'] = ui.input(
+                    label=state.t('ensemble_weights'),
+                    value=', '.join(str(w) for w in ensemble.get('weights', [])),
+                    on_change=lambda e: update_ensemble_settings(weights=parse_weights(e.value))
+                ).classes('flex-1')
+            
             # 置信度阈值
             state.ui_refs['confidence_threshold_label'] = ui.label(state.t('confidence_threshold')).classes('text-sm text-gray-600 mb-1')
             global threshold_slider, threshold_label
@@ -710,6 +1849,17 @@ def create_right_panel():
             threshold_label = ui.label(state.t('current_value', value=f'{threshold:.2f}')).classes('text-sm text-gray-500 mb-3')
             state.ui_refs['threshold_label'] = threshold_label
             
+            # 输出规则
+            state.ui_refs['output_profile_label'] = ui.label(state.t('output_profile')).classes('text-sm text-gray-600 mb-1')
+            global profile_select
+            profiles = {'': state.t('no_profile'), **{name: name for name in get_output_profiles()}}
+            last_profile = get_last_profile()
+            profile_select = ui.select(
+                options=profiles,
+                value=last_profile if last_profile in profiles else '',
+                on_change=lambda e: set_last_profile(e.value or '')
+            ).classes('w-full mb-3')
+            
             # 输出路径
             state.ui_refs['output_path_label'] = ui.label(state.t('output_path')).classes('text-sm text-gray-600 mb-1')
             global output_input
@@ -717,12 +1867,52 @@ def create_right_panel():
             output_input = ui.input(
                 value=output_dir,
                 on_change=lambda e: set_output_dir(e.value)
+            ).classes('w-full mb-2')
+            
+            # 输出方式
+            state.ui_refs['output_mode_select'] = ui.select(
+                options={mode: state.t('output_mode_' + mode) for mode in OUTPUT_MODES},
+                value=get_output_mode(),
+                label=state.t('output_mode'),
+                on_change=lambda e: set_output_mode(e.value)
+            ).classes('w-full mb-3')
+            
+            # 已有 txt 时的处理方式
+            state.ui_refs['retag_mode_select'] = ui.select(
+                options={mode: state.t('retag_mode_' + mode) for mode in RETAG_MODES},
+                value=get_retag_mode(),
+                label=state.t('retag_mode'),
+                on_change=lambda e: set_retag_mode(e.value)
             ).classes('w-full mb-3')
             
             state.ui_refs['open_output_folder_button'] = ui.button(state.t('open_output_folder'), on_click=lambda: open_output_folder(output_input.value)).classes('w-full bg-yellow-100 text-gray-700')
+            
+            # 独立推理进程
+            state.ui_refs['inference_server_switch'] = ui.switch(
+                state.t('inference_server'),
+                value=get_inference_server_settings().get('enabled', False),
+                on_change=lambda e: toggle_inference_server(e.value)
+            ).classes('w-full mt-2')
+        
+        # 监视文件夹
+        with ui.card().classes('w-full p-4'):
+            state.ui_refs['watch_folder_label'] = ui.label(state.t('watch_folder')).classes('text-lg font-semibold mb-3')
+            global watch_input
+            watch_input = ui.textarea(
+                value='\n'.join(get_watch_dirs()),
+                placeholder=state.t('watch_dirs_placeholder')
+            ).props('autogrow dense').classes('w-full mb-2')
+            state.ui_refs['watch_input'] = watch_input
+            state.ui_refs['watch_button'] = ui.button(state.t('start_watch'), on_click=toggle_folder_watch).classes('w-full bg-green-500 text-white')
+            state.ui_refs['watch_status'] = ui.label('').classes('text-xs text-gray-500 mt-1')
+            ui.timer(2.0, update_watch_status)
         
         # 处理区域
         with ui.card().classes('w-full p-4'):
+            global priority_input
+            state.ui_refs['job_priority_label'] = ui.label(state.t('job_priority')).classes('text-sm text-gray-600 mb-1')
+            priority_input = ui.number(value=0, step=1, format='%d').classes('w-full mb-3')
+            
             state.ui_refs['start_processing_button'] = ui.button(state.t('start_processing'), on_click=start_processing).classes('w-full bg-blue-500 text-white text-lg py-3')
             
             # 进度条
@@ -738,7 +1928,7 @@ def create_right_panel():
 
 # ============ 事件处理 ============
 
-def handle_upload(e: UploadEventArguments):
+async def handle_upload(e: UploadEventArguments):
     """处理文件上传"""
     if not e.content:
         return
@@ -751,16 +1941,29 @@ def handle_upload(e: UploadEventArguments):
     with open(file_path, 'wb') as f:
         f.write(e.content.read())
     
-    if str(file_path) not in state.image_paths:
-        state.image_paths.append(str(file_path))
-        state.selected_indices.discard(len(state.image_paths) - 1)
+    valid, rejected = await run.io_bound(filter_valid_images, [str(file_path)])
+    if rejected:
+        notify_rejected(rejected)
+        return
+    state.catalog.add(valid)
     
     update_gallery()
     ui.notify(state.t('file_added', name=e.name), type='positive')
 
 
+def notify_rejected(rejected: List[Tuple[str, str]]):
+    """提示被拒绝的损坏或无法读取的文件"""
+    if not rejected:
+        return
+    names = ', '.join(f'{os.path.basename(path)} ({error})' for path, error in rejected[:5])
+    if len(rejected) > 5:
+        names += ' ...'
+    print(f"[探测] 拒绝 {len(rejected)} 个文件: " + '; '.join(f'{path}: {error}' for path, error in rejected))
+    ui.notify(state.t('rejected_files', count=len(rejected), names=names), type='warning', multi_line=True)
+
+
 def update_gallery():
-    """更新画廊显示"""
+    """更新画廊显示（只渲染当前页）"""
     global gallery_grid, status_label
     
     # 检查 gallery_grid 是否存在
@@ -771,17 +1974,25 @@ def update_gallery():
     gallery_grid.clear()
     
     # 如果没有图片，显示提示
-    if not state.image_paths:
+    if not len(state.catalog):
         with gallery_grid:
             ui.label(state.t('no_images')).classes('text-gray-400 col-span-full text-center py-8')
+        update_pagination(0)
         # 更新状态标签
-        if 'status_label' in globals() and status_label is not None:
-            status_label.set_text(f'共 0 张图片，选中 0 张')
+        update_status_label()
         return
     
+    # 按标签筛选时只显示匹配的图片（索引直接返回图片目录的 id）
+    visible = tag_index.query_keys(state.gallery_filter) if state.gallery_filter else None
+    total = state.catalog.count() if visible is None else len(visible)
+    pages = max(1, -(-total // GALLERY_PAGE_SIZE))
+    state.gallery_page = min(max(1, state.gallery_page), pages)
+    update_pagination(pages)
+    
     # 添加图片卡片
-    for idx, path in enumerate(state.image_paths):
-        is_selected = idx in state.selected_indices
+    for item in state.catalog.page((state.gallery_page - 1) * GALLERY_PAGE_SIZE, GALLERY_PAGE_SIZE, ids=visible):
+        path = item.path
+        is_selected = item.id in state.catalog.selected
         
         # 创建图片卡片
         card_classes = 'cursor-pointer transition-all duration-200 hover:shadow-lg '
@@ -791,76 +2002,138 @@ def update_gallery():
             card_classes += 'hover:ring-2 hover:ring-gray-300'
         
         with gallery_grid:
-            with ui.card().classes(card_classes).on('click', lambda i=idx: toggle_selection(i)):
+            with ui.card().classes(card_classes).on('click', lambda i=item.id: toggle_selection(i)):
                 # 全图缩小显示，保持宽高比，object-contain 显示完整图片
                 # 将路径转换为绝对路径，确保 NiceGUI 能正确加载
                 abs_path = os.path.abspath(path)
-                ui.image(abs_path).classes('w-full h-48 object-contain bg-gray-50 rounded')
-                # 显示文件名
-                ui.label(os.path.basename(path)[:20] + '...' if len(os.path.basename(path)) > 20 else os.path.basename(path)).classes('text-xs text-center mt-1 truncate')
+                if is_video_file(path) or is_archive_file(path):
+                    with ui.element('div').classes('w-full h-48 flex items-center justify-center bg-gray-50 rounded'):
+                        ui.icon('movie' if is_video_file(path) else 'folder_zip', size='64px').classes('text-gray-400')
+                else:
+                    ui.image(abs_path).classes('w-full h-48 object-contain bg-gray-50 rounded')
+                # 显示文件名和处理状态
+                with ui.row().classes('w-full items-center justify-center gap-1 no-wrap'):
+                    if item.status == 'tagged':
+                        ui.icon('check_circle', size='14px').classes('text-green-500')
+                    elif item.status == 'failed':
+                        ui.icon('error', size='14px').classes('text-red-500').tooltip(item.result)
+                    ui.label(os.path.basename(path)[:20] + '...' if len(os.path.basename(path)) > 20 else os.path.basename(path)).classes('text-xs text-center mt-1 truncate')
+                info = cached_image_info(path)
+                if info is not None and info.width:
+                    ui.label(f'{info.width}×{info.height}').classes('text-xs text-center text-gray-400 w-full')
     
     # 更新状态标签
-    if 'status_label' in globals() and status_label is not None:
-        status_label.set_text(f'共 {len(state.image_paths)} 张图片，选中 {len(state.selected_indices)} 张')
+    update_status_label()
+
+
+def update_pagination(pages: int):
+    """刷新画廊分页控件"""
+    pagination = state.ui_refs.get('gallery_pagination')
+    if pagination is None:
+        return
+    pagination.max = max(1, pages)
+    pagination.value = state.gallery_page
+    pagination.set_visibility(pages > 1)
+
+
+def update_tag_stats():
+    """刷新数据集标签频次"""
+    if 'tag_stats_label' not in state.ui_refs:
+        return
+    stats = tag_index.frequencies(top=TAG_STATS_TOP)
+    text = state.t('tag_stats_summary', images=len(tag_index)) + '\n' + ', '.join(f'{tag} ({count})' for tag, count in stats)
+    state.ui_refs['tag_stats_label'].set_text(text)
 
 
 def update_status_label():
     """更新状态标签"""
     global status_label
     if 'status_label' in globals() and status_label is not None:
-        status_label.set_text(f'共 {len(state.image_paths)} 张图片，选中 {len(state.selected_indices)} 张')
+        status_label.set_text(state.t('files_uploaded', count=len(state.catalog), selected=len(state.catalog.selected)))
 
 
-def toggle_selection(idx: int):
+def toggle_selection(item_id: int):
     """切换选择状态"""
-    if idx in state.selected_indices:
-        state.selected_indices.remove(idx)
+    if item_id in state.catalog.selected:
+        state.catalog.selected.remove(item_id)
     else:
-        state.selected_indices.add(idx)
+        state.catalog.selected.add(item_id)
     update_gallery()
 
 
 def delete_selected():
     """删除选中的图片"""
-    if not state.selected_indices:
+    if not state.catalog.selected:
         ui.notify(state.t('please_select_images_to_delete'), type='warning')
         return
     
-    # 按索引降序排序，避免删除时索引变化
-    sorted_indices = sorted(state.selected_indices, reverse=True)
-    for idx in sorted_indices:
-        if 0 <= idx < len(state.image_paths):
-            state.image_paths.pop(idx)
-    
-    # 重新构建选中索引
-    state.selected_indices.clear()
+    removed = [state.catalog.get(item_id).path for item_id in state.catalog.selected]
+    count = state.catalog.remove(list(state.catalog.selected))
+    tag_index.remove(removed)
     update_gallery()
-    ui.notify(state.t('images_deleted', count=len(sorted_indices)), type='positive')
+    update_tag_stats()
+    ui.notify(state.t('images_deleted', count=count), type='positive')
 
 
 def clear_all():
     """清空所有图片"""
-    state.image_paths.clear()
-    state.selected_indices.clear()
+    state.catalog.clear()
+    tag_index.clear()
     update_gallery()
+    update_tag_stats()
     ui.notify(state.t('all_images_cleared'), type='positive')
 
 
+def set_catalog_persist(enabled: bool):
+    """开启/关闭图片列表持久化（保存到 catalog.db，重启后恢复）"""
+    settings = {**get_catalog_settings(), 'persist': enabled}
+    config = load_config()
+    config['catalog'] = settings
+    save_config(config)
+    if enabled:
+        state.catalog.attach(settings['path'])
+        tag_index.set_keys(state.catalog.id_of)  # attach 会给已有图片重新编号
+    else:
+        state.catalog.detach()
+    update_gallery()
+
+
+def parse_weights(text: str) -> List[float]:
+    """解析逗号分隔的模型权重，格式错误时返回空列表（等权重）"""
+    try:
+        return [float(w) for w in text.replace('，', ',').split(',') if w.strip()]
+    except ValueError:
+        return []
+
+
+def update_ensemble_settings(**changes):
+    """更新并保存集成模式设置"""
+    settings = get_ensemble_settings()
+    settings.update(changes)
+    set_ensemble_settings(settings)
+
+
 def refresh_models():
     """刷新模型列表"""
     models = get_wd14_models()
     model_select.options = models
     model_select.value = models[0] if models else DEFAULT_MODEL
+    ensemble_select.options = models
+    ensemble_select.value = [m for m in (ensemble_select.value or []) if m in models]
+    profile_select.options = {'': state.t('no_profile'), **{name: name for name in get_output_profiles()}}
+    if profile_select.value not in profile_select.options:
+        profile_select.value = ''
     ui.notify(state.t('models_refreshed'), type='positive')
 
 
-def check_txt_exists(image_path: str, output_dir: str) -> tuple[bool, bool]:
+def check_txt_exists(image_path: str, output_dir: str, output_mode: str = 'flat',
+                     input_root: Optional[str] = None) -> tuple[bool, bool]:
     """检查对应的 txt 文件是否已存在，以及是否超过1KB
     返回: (是否存在, 是否超过1KB需要重新打标)
     """
     image_name = os.path.basename(image_path)
-    txt_name = os.path.splitext(image_name)[0] + ".txt"
-    txt_path = os.path.join(output_dir, txt_name)
+    txt_path = get_txt_path(image_path, output_dir, output_mode, input_root)
+    txt_name = os.path.basename(txt_path)
     # 转换为绝对路径确保一致性
     txt_path = os.path.abspath(txt_path)
     
@@ -884,182 +2157,2560 @@ def check_txt_exists(image_path: str, output_dir: str) -> tuple[bool, bool]:
     
     return True, False
 
-async def process_single_image(image_path: str, model: str, threshold: float, output_dir: str, lang: str = 'zh') -> tuple:
-    """处理单张图片 - 在线程池中运行避免阻塞 UI"""
-    def _process():
-        image_name = os.path.basename(image_path)
-        txt_name = os.path.splitext(image_name)[0] + ".txt"
-        txt_path = os.path.join(output_dir, txt_name)
-        
-        # 根据语言选择文本
-        if lang == 'en':
-            skipped_msg = f"Skipped (txt exists): {txt_name}"
-            delete_failed_msg = "Failed to delete oversized file: {error}"
-            processing_failed_msg = "Processing failed: {error}"
-            retagged_msg = "Retagged: {filename}"
-        else:
-            skipped_msg = f"已跳过 (txt已存在): {txt_name}"
-            delete_failed_msg = "删除超大文件失败: {error}"
-            processing_failed_msg = "处理失败: {error}"
-            retagged_msg = "重新打标: {filename}"
-        
+# ============ 视频打标 ============
+
+def is_video_file(path: str) -> bool:
+    return path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def frame_signature(frame: np.ndarray) -> Tuple[np.ndarray, int]:
+    """在缩小后的帧上计算 (HSV 颜色直方图, 64位差值哈希)，用于场景切换检测和去重"""
+    small = cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 16], [0, 180, 0, 256])
+    cv2.normalize(hist, hist)
+    gray = cv2.resize(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+    dhash = int.from_bytes(np.packbits(gray[:, 1:] > gray[:, :-1]).tobytes(), 'big')
+    return hist, dhash
+
+
+def iter_video_frames(video_path: str, mode: str = 'scene', interval: float = VIDEO_SAMPLE_INTERVAL,
+                      scene_threshold: float = VIDEO_SCENE_THRESHOLD,
+                      duplicate_distance: int = VIDEO_DUPLICATE_DISTANCE, stats: Optional[dict] = None):
+    """流式读取视频，逐个产出采样帧 (帧序号, 时间戳秒, BGR帧)，整段视频不会驻留内存
+    
+    interval 模式每隔 interval 秒取一帧；scene 模式每秒检查约 4 帧，
+    颜色直方图变化超过 scene_threshold 时取帧，同一场景内最长 interval 秒补取一帧。
+    与上一个产出帧的感知哈希距离不超过 duplicate_distance 的帧在进入模型前丢弃。
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise IOError(f"无法打开视频: {video_path}")
+    stats = stats if stats is not None else {}
+    stats.update({'decoded': 0, 'sampled': 0, 'duplicates': 0})
+    
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    interval_frames = max(1, round(fps * interval))
+    check_frames = interval_frames if mode == 'interval' else max(1, round(fps / 4))
+    last_hist, last_hash, last_emitted = None, None, None
+    frame_index = -1
+    try:
+        while True:
+            # 不需要检查的帧只 grab 不解码
+            if not capture.grab():
+                break
+            frame_index += 1
+            if frame_index % check_frames:
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+            stats['decoded'] += 1
+            hist, dhash = frame_signature(frame)
+            
+            if mode == 'interval' or last_emitted is None:
+                candidate = True
+            else:
+                scene_changed = cv2.compareHist(last_hist, hist, cv2.HISTCMP_BHATTACHARYYA) > scene_threshold
+                candidate = scene_changed or frame_index - last_emitted >= interval_frames
+            last_hist = hist
+            if not candidate:
+                continue
+            
+            if last_hash is not None and bin(dhash ^ last_hash).count('1') <= duplicate_distance:
+                stats['duplicates'] += 1
+                continue
+            last_hash, last_emitted = dhash, frame_index
+            stats['sampled'] += 1
+            yield frame_index, frame_index / fps, frame
+    finally:
+        capture.release()
+
+
+def process_video(video_path: str, options: 'TaggingOptions', stats: Optional[dict] = None) -> Tuple[str, str]:
+    """视频打标：抽帧、去重后分批推理，输出逐帧 txt（<文件名>_f<帧序号>.txt）和整段视频的汇总 txt
+    
+    diff 模式下逐帧 txt 和汇总 txt 都先与已有内容比较，标签未变化的不改写，
+    传入 stats 时差异记入其中的 tag_diff（见 record_tag_diff）。
+    返回: (状态, 汇总 txt 路径或错误信息)，汇总标签未变化时状态为 unchanged
+    """
+    video = options.video
+    stem = os.path.splitext(video_path)[0]
+    frame_stats: dict = {}
+    tag_counts: Dict[str, int] = {}
+    batch: List[Tuple[int, np.ndarray]] = []
+    
+    def save(source_path: str, tags: List[str]) -> Tuple[str, str]:
+        if options.retag_mode == 'diff':
+            txt_path = get_txt_path(source_path, options.output_dir, **options.layout)
+            old_tags = read_txt_tags(txt_path)
+            if old_tags is not None:
+                added, removed = tag_diff(old_tags, tags)
+                if stats is not None:
+                    record_tag_diff(stats, added, removed)
+                if not added and not removed:
+                    return 'unchanged', txt_path
+        success, msg = save_tags_to_txt(source_path, ", ".join(tags), "", options.output_dir, **options.layout)
+        return ('completed' if success else 'failed'), msg
+    
+    def flush():
+        general_output, character_output, tag_data = infer_tag_scores(
+            options.model, np.concatenate([array for _, array in batch], axis=0),
+            options.ensemble_mode, options.ensemble_weights)
+        for row, (frame_index, _) in enumerate(batch):
+            tags = [tag for tag, _ in scores_to_tags(
+                general_output[row], character_output[row] if character_output is not None else None,
+                tag_data, options.threshold, compile_tag_rules(options.profile, tag_data))]
+            for tag in tags:
+                tag_counts[tag] = tag_counts.get(tag, 0) + 1
+            save(f"{stem}_f{frame_index:06d}.jpg", tags)
+        batch.clear()
+    
+    try:
+        for frame_index, _, frame in iter_video_frames(
+                video_path, video.get('mode', 'scene'), video.get('interval', VIDEO_SAMPLE_INTERVAL),
+                video.get('scene_threshold', VIDEO_SCENE_THRESHOLD),
+                video.get('duplicate_distance', VIDEO_DUPLICATE_DISTANCE), frame_stats):
+            batch.append((frame_index, preprocess_frame(frame)))
+            if len(batch) >= options.batch_size:
+                flush()
+        if batch:
+            flush()
+    except Exception as e:
+        print(f"视频处理失败: {e}")
+        return 'failed', f"Error: {str(e)}"
+    
+    if not frame_stats.get('sampled'):
+        return 'failed', "Error: 视频中没有可用的帧"
+    print(f"[视频] {os.path.basename(video_path)}: 解码 {frame_stats['decoded']} 帧, "
+          f"采样 {frame_stats['sampled']} 帧, 去重丢弃 {frame_stats['duplicates']} 帧")
+    
+    # 整段视频：按出现帧数排序，保留出现比例足够高的标签
+    min_count = max(1, int(np.ceil(frame_stats['sampled'] * VIDEO_CLIP_MIN_RATIO)))
+    clip_tags = [tag for tag, count in sorted(tag_counts.items(), key=lambda item: -item[1]) if count >= min_count]
+    return save(video_path, clip_tags)
+
+
+# ============ 压缩包打标 ============
+
+def is_archive_file(path: str) -> bool:
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_stem(archive_path: str) -> str:
+    """去掉压缩包扩展名（包括 .tar.gz 这类双扩展名）后的文件名"""
+    name = os.path.basename(archive_path)
+    for ext in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def iter_archive_images(archive_path: str):
+    """按压缩包中的顺序逐个读取图片成员，每个成员只读一次，不解压到磁盘
+    
+    tar 以流模式顺序读取（支持 gz/bz2/xz 压缩）；zip 按目录顺序读取。
+    生成 (成员路径, 文件内容)，跳过目录、非图片和路径不安全的成员。
+    """
+    def safe_name(name: str) -> Optional[str]:
+        name = posixpath.normpath(name.replace('\\', '/'))
+        # 拒绝绝对路径、带盘符的路径（Windows 下 os.path.join 会丢弃输出目录）和向上跳出的路径
+        if posixpath.isabs(name) or ntpath.splitdrive(name)[0] or ':' in name:
+            return None
+        if name == '..' or name.startswith('../') or not name.lower().endswith(IMAGE_EXTENSIONS):
+            return None
+        return name
+    
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                name = safe_name(info.filename)
+                if name and not info.is_dir():
+                    yield name, archive.read(info)
+        return
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for member in archive:
+            name = safe_name(member.name)
+            if name and member.isfile():
+                yield name, archive.extractfile(member).read()
+
+
+def archive_output_root(archive_path: str, options: 'TaggingOptions') -> str:
+    """压缩包成员的输出根目录：压缩包对应的输出位置按输出方式确定，成员在其下按成员路径展开"""
+    return os.path.join(os.path.dirname(get_txt_path(archive_path, options.output_dir, **options.layout)),
+                        archive_stem(archive_path))
+
+
+def process_archive(archive_path: str, options: 'TaggingOptions', stats: Optional[dict] = None) -> Tuple[str, str]:
+    """压缩包打标：边读取边在预处理线程池中解码，按批推理
+    
+    输出按成员路径命名：<压缩包的输出目录>/<压缩包名>/<成员目录>/<成员文件名>.txt，
+    已有 txt 的成员会被跳过（规则与普通图片相同），diff 模式下标签未变化的成员计为跳过，
+    传入 stats 时差异记入其中的 tag_diff（见 record_tag_diff）。
+    返回: (状态, 汇总信息或错误信息)，成功时状态为 'archive'，汇总信息包含各成员的计数
+    """
+    messages = _result_messages(options.lang)
+    output_root = archive_output_root(archive_path, options)
+    pool = get_preprocess_pool(options.workers)
+    counts = {'completed': 0, 'skipped': 0, 'failed': 0}
+    pending: deque = deque()  # (成员路径, 预处理 Future)，保持压缩包顺序
+    
+    def flush(count: int):
+        batch = [pending.popleft() for _ in range(min(count, len(pending)))]
+        decoded = []
+        for name, future in batch:
+            image_array, _ = future.result()
+            if image_array is None:
+                counts['failed'] += 1
+            else:
+                decoded.append((name, image_array))
+        if not decoded:
+            return
+        general_output, character_output, tag_data = infer_tag_scores(
+            options.model, np.concatenate([array for _, array in decoded], axis=0),
+            options.ensemble_mode, options.ensemble_weights)
+        rules = compile_tag_rules(options.profile, tag_data)
+        for row, (name, _) in enumerate(decoded):
+            tags = scores_to_tags(general_output[row], character_output[row] if character_output is not None else None,
+                                  tag_data, options.threshold, rules)
+            member_dir = os.path.join(output_root, posixpath.dirname(name))
+            if options.retag_mode == 'diff':
+                old_tags = read_txt_tags(get_txt_path(name, member_dir))
+                if old_tags is not None:
+                    added, removed = tag_diff(old_tags, [tag for tag, _ in tags])
+                    if stats is not None:
+                        record_tag_diff(stats, added, removed)
+                    if not added and not removed:
+                        counts['skipped'] += 1
+                        continue
+            success, _ = save_tags_to_txt(name, ", ".join(tag for tag, _ in tags), "", member_dir)
+            counts['completed' if success else 'failed'] += 1
+    
+    root = os.path.realpath(output_root)
+    try:
+        for name, data in iter_archive_images(archive_path):
+            if os.path.commonpath([root, os.path.realpath(os.path.join(root, name))]) != root:
+                # 成员路径经符号链接等解析后不在输出目录内
+                counts['failed'] += 1
+                continue
+            exists, needs_retag = check_txt_exists(name, os.path.join(output_root, posixpath.dirname(name)))
+            if exists and not needs_retag and options.retag_mode == 'skip':
+                counts['skipped'] += 1
+                continue
+            pending.append((name, pool.submit(preprocess_image_guarded, io.BytesIO(data))))
+            # 多读入一批，解码与下一批的读取重叠
+            if len(pending) >= options.batch_size * 2:
+                flush(options.batch_size)
+        while pending:
+            flush(options.batch_size)
+    except Exception as e:
+        print(f"压缩包处理失败: {e}")
+        return 'failed', f"Error: {str(e)}"
+    
+    summary = messages['archive_summary'].format(file=os.path.basename(archive_path), dir=output_root, **counts)
+    print(f"[压缩包] {summary}")
+    if not counts['completed'] and not counts['skipped']:
+        return 'failed', summary
+    return 'archive', summary
+
+
+class TaggingOptions:
+    """一次处理所需的参数，可序列化后传给独立推理进程"""
+    def __init__(self, model: Union[str, List[str]], threshold: float, output_dir: str, lang: str = 'zh',
+                 ensemble_mode: str = 'mean', ensemble_weights: Optional[List[float]] = None,
+                 video: Optional[dict] = None, profile: Optional[dict] = None, retag_mode: str = 'skip',
+                 batch_size: Optional[int] = None, workers: Optional[int] = None,
+                 output_mode: str = 'flat', input_root: Optional[str] = None):
+        self.model = model  # 模型名称列表表示集成模式，见 infer_tag_scores
+        self.threshold = threshold
+        self.output_dir = output_dir
+        self.lang = lang
+        self.ensemble_mode = ensemble_mode
+        self.ensemble_weights = ensemble_weights
+        self.video = video or get_video_settings()  # 视频抽帧设置
+        self.profile = profile  # 输出规则内容，见 CompiledTagRules
+        self.retag_mode = retag_mode  # 已有 txt 时：skip 跳过，overwrite 重新打标并覆盖，diff 只改写标签有变化的文件
+        self.batch_size = batch_size or JOB_BATCH_SIZE  # 每批图片数和预处理线程数，见 autotune_model
+        self.workers = workers or PREPROCESS_WORKERS
+        self.output_mode = output_mode  # txt 输出方式，见 get_txt_path
+        self.input_root = input_root
+    
+    @property
+    def model_label(self) -> str:
+        if isinstance(self.model, str):
+            return self.model
+        return '+'.join(self.model) + f' ({self.ensemble_mode})'
+    
+    @property
+    def layout(self) -> dict:
+        """传给 get_txt_path / save_tags_to_txt 的输出方式参数"""
+        return {'output_mode': self.output_mode, 'input_root': self.input_root}
+    
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TaggingOptions':
+        return cls(**data)
+
+
+def normalize_tag(tag: str) -> str:
+    """比较标签时忽略空格/下划线写法和首尾空白"""
+    return tag.strip().replace(' ', '_')
+
+
+def read_txt_tags(txt_path: str) -> Optional[List[str]]:
+    """读取已有 txt 中的标签，文件不存在时返回 None（不是 UTF-8 的字节会被替换）"""
+    try:
+        with open(txt_path, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+    except OSError:
+        return None
+    return [tag.strip() for tag in content.split(',') if tag.strip()]
+
+
+def tag_diff(old_tags: List[str], new_tags: List[str]) -> Tuple[List[str], List[str]]:
+    """比较两组标签（按 normalize_tag 后的集合），返回 (新增, 删除)"""
+    old = {normalize_tag(tag) for tag in old_tags}
+    new = {normalize_tag(tag) for tag in new_tags}
+    return sorted(new - old), sorted(old - new)
+
+
+def _result_messages(lang: str) -> dict:
+    """根据语言选择处理结果文本"""
+    if lang == 'en':
+        return {
+            'skipped': "Skipped (txt exists): {file}",
+            'delete_failed': "Failed to delete oversized file: {error}",
+            'processing_failed': "Processing failed: {error}",
+            'retagged': "Retagged: {filename}",
+            'retagged_diff': "Updated: {filename} (+{added} / -{removed})",
+            'unchanged': "Unchanged: {file}",
+            'archive_summary': "{file}: {completed} tagged, {skipped} skipped, {failed} failed -> {dir}",
+        }
+    return {
+        'skipped': "已跳过 (txt已存在): {file}",
+        'delete_failed': "删除超大文件失败: {error}",
+        'processing_failed': "处理失败: {error}",
+        'retagged': "重新打标: {filename}",
+        'retagged_diff': "已更新: {filename} (+{added} / -{removed})",
+        'unchanged': "标签未变化: {file}",
+        'archive_summary': "{file}: 已打标 {completed} 张, 跳过 {skipped} 张, 失败 {failed} 张 -> {dir}",
+    }
+
+
+_preprocess_pools: Dict[int, ThreadPoolExecutor] = {}
+_preprocess_pools_lock = threading.Lock()
+
+
+def get_preprocess_pool(workers: int) -> ThreadPoolExecutor:
+    """按线程数复用预处理线程池"""
+    with _preprocess_pools_lock:
+        if workers not in _preprocess_pools:
+            _preprocess_pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wd14-preprocess')
+        return _preprocess_pools[workers]
+
+
+def process_image_batch(image_paths: List[str], options: TaggingOptions,
+                        stats: Optional[dict] = None) -> List[Tuple[str, str, str]]:
+    """批量处理图片：跳过已有 txt 的图片，其余图片按尺寸从大到小并行预处理，
+    先完成的图片每 options.batch_size 张合并为一个批次推理，视频逐个抽帧处理
+    返回: 每张图片的 (状态, 消息, 限流说明)，状态为 completed / retagged / skipped / failed，
+    限流说明见 preprocess_image_guarded；传入 stats 时累计处理统计（尺寸分组耗时、标签差异）
+    
+    retag_mode 为 diff 时，已有 txt 的图片重新推理后与原有标签比较（见 normalize_tag），
+    标签集合相同的不写入文件，状态为 unchanged
+    """
+    output_dir = options.output_dir
+    messages = _result_messages(options.lang)
+    results: List[Optional[Tuple[str, str, str]]] = [None] * len(image_paths)
+    candidates = []  # (序号, 是否重新打标)
+    
+    for i, image_path in enumerate(image_paths):
+        txt_name = os.path.splitext(os.path.basename(image_path))[0] + ".txt"
+        if is_archive_file(image_path):
+            # 压缩包按成员逐个判断是否跳过，见 process_archive
+            results[i] = (*process_archive(image_path, options, stats), '')
+            continue
         try:
             # 首先检查 txt 文件是否已存在
-            exists, needs_retag = check_txt_exists(image_path, output_dir)
-            
-            if exists and not needs_retag:
+            exists, needs_retag = check_txt_exists(image_path, output_dir, **options.layout)
+            if exists and options.retag_mode in ('overwrite', 'diff'):
+                needs_retag = True
+            elif exists and not needs_retag:
                 # 文件存在且大小正常，跳过
-                return True, skipped_msg
-            
-            if exists and needs_retag:
+                results[i] = ('skipped', messages['skipped'].format(file=txt_name), '')
+                continue
+            if exists and needs_retag and options.retag_mode == 'skip':
                 # 文件存在但超过1KB，删除并重新打标
                 try:
-                    os.remove(txt_path)
+                    os.remove(get_txt_path(image_path, output_dir, **options.layout))
                 except Exception as e:
-                    return False, delete_failed_msg.format(error=e)
-            
-            # 调用 WD14tagger
-            english_tags, chinese_description = get_image_tags(image_path, model, threshold)
+                    results[i] = ('failed', messages['delete_failed'].format(error=e), '')
+                    continue
             
-            if english_tags.startswith('Error:'):
-                return False, english_tags
-            else:
-                success, msg = save_tags_to_txt(image_path, english_tags, chinese_description, output_dir)
-                if success and exists and needs_retag:
-                    # 如果是重新打标，修改返回消息
-                    return True, retagged_msg.format(filename=os.path.basename(msg))
-                return success, msg
+            if is_video_file(image_path):
+                status, msg = process_video(image_path, options, stats)
+                if status == 'unchanged':
+                    msg = messages['unchanged'].format(file=os.path.basename(msg))
+                elif status != 'failed' and exists and needs_retag:
+                    status, msg = 'retagged', messages['retagged'].format(filename=os.path.basename(msg))
+                results[i] = (status, msg, '')
+                continue
+            candidates.append((i, exists and needs_retag))
         except Exception as e:
-            return False, processing_failed_msg.format(error=str(e))
+            results[i] = ('failed', messages['processing_failed'].format(error=str(e)), '')
+    
+    def infer_batch(pending: List[Tuple[int, bool, np.ndarray, str]]):
+        """对已完成预处理的图片推理并保存，pending 为 (序号, 是否重新打标, 预处理结果, 限流说明)"""
+        try:
+            general_output, character_output, tag_data = infer_tag_scores(
+                options.model, np.concatenate([image_array for _, _, image_array, _ in pending], axis=0),
+                options.ensemble_mode, options.ensemble_weights)
+        except Exception as e:
+            print(f"推理失败: {e}")
+            for i, _, _, note in pending:
+                results[i] = ('failed', f"Error: {str(e)}", note)
+            return
+        
+        rules = compile_tag_rules(options.profile, tag_data)
+        for row, (i, retagged, _, note) in enumerate(pending):
+            try:
+                tags = scores_to_tags(general_output[row],
+                                      character_output[row] if character_output is not None else None,
+                                      tag_data, options.threshold, rules)
+                english_tags = ", ".join(tag for tag, _ in tags)
+                diff = None
+                if retagged and options.retag_mode == 'diff':
+                    txt_path = get_txt_path(image_paths[i], output_dir, **options.layout)
+                    old_tags = read_txt_tags(txt_path)
+                    if old_tags is not None:
+                        diff = tag_diff(old_tags, [tag for tag, _ in tags])
+                        if stats is not None:
+                            record_tag_diff(stats, *diff)
+                        if not diff[0] and not diff[1]:
+                            results[i] = ('unchanged', messages['unchanged'].format(file=os.path.basename(txt_path)), note)
+                            continue
+                success, msg = save_tags_to_txt(image_paths[i], english_tags, "", output_dir, **options.layout)
+                if not success:
+                    results[i] = ('failed', msg, note)
+                elif diff is not None:
+                    results[i] = ('retagged', messages['retagged_diff'].format(
+                        filename=os.path.basename(msg), added=', '.join(diff[0]) or '-',
+                        removed=', '.join(diff[1]) or '-'), note)
+                elif retagged:
+                    results[i] = ('retagged', messages['retagged'].format(filename=os.path.basename(msg)), note)
+                else:
+                    results[i] = ('completed', msg, note)
+            except Exception as e:
+                results[i] = ('failed', messages['processing_failed'].format(error=str(e)), note)
     
-    return await run.io_bound(_process)
+    # 并行预处理，总内存受全局配额限制；按文件头中的尺寸从大到小提交，
+    # 耗时长的大图先开始，各线程负载更均衡
+    # 优先使用添加图片时缓存的探测结果；没有缓存时（监视任务、从 SQLite 恢复的图片目录、
+    # 独立推理进程中）在探测线程池中并行读取
+    infos = {i: cached_image_info(image_paths[i]) for i, _ in candidates}
+    missing = [i for i, info in infos.items() if info is None]
+    infos.update(zip(missing, _probe_pool.map(probe_image, [image_paths[i] for i in missing])))
+    pixels = {i: info.pixels for i, info in infos.items()}
+    pool = get_preprocess_pool(options.workers)
+    futures = {pool.submit(_timed_preprocess, image_paths[i]): (i, retagged)
+               for i, retagged in sorted(candidates, key=lambda c: -pixels[c[0]])}
+    
+    # 先完成预处理的图片先凑成推理批次
+    ready = []
+    for future in as_completed(futures):
+        i, retagged = futures[future]
+        (image_array, note), seconds = future.result()
+        if stats is not None:
+            record_bucket_stats(stats, pixels[i], seconds)
+        if image_array is None:
+            results[i] = ('failed', "Error: 图片预处理失败", note)
+            continue
+        ready.append((i, retagged, image_array, note))
+        if len(ready) >= options.batch_size:
+            infer_batch(ready)
+            ready = []
+    if ready:
+        infer_batch(ready)
+    return results
 
-async def start_processing():
-    """开始处理图片 - 使用后台线程避免 UI 卡顿"""
-    if not state.image_paths:
-        ui.notify(state.t('please_upload_images_first'), type='warning')
-        return
+
+SIZE_BUCKETS = (('small', 0.5e6), ('medium', 4e6), ('large', 16e6), ('huge', float('inf')))  # (名称, 像素上限)
+
+
+def size_bucket(pixels: int) -> str:
+    """按像素数划分的尺寸分组"""
+    return next(name for name, limit in SIZE_BUCKETS if pixels <= limit)
+
+
+def _timed_preprocess(image_path: str) -> Tuple[Tuple[Optional[np.ndarray], str], float]:
+    started = time.perf_counter()
+    result = preprocess_image_guarded(image_path)
+    return result, time.perf_counter() - started
+
+
+def record_bucket_stats(stats: dict, pixels: int, seconds: float):
+    """在处理统计的 buckets 中累计各尺寸分组的图片数和预处理耗时"""
+    bucket = stats.setdefault('buckets', {}).setdefault(size_bucket(pixels), {'images': 0, 'seconds': 0.0})
+    bucket['images'] += 1
+    bucket['seconds'] += seconds
+
+
+def record_tag_diff(stats: dict, added: List[str], removed: List[str]):
+    """在处理统计的 tag_diff 中累计差异重新打标的结果"""
+    diff = stats.setdefault('tag_diff', {'changed': 0, 'unchanged': 0, 'added': {}, 'removed': {}})
+    diff['changed' if added or removed else 'unchanged'] += 1
+    for key, tags in (('added', added), ('removed', removed)):
+        for tag in tags:
+            diff[key][tag] = diff[key].get(tag, 0) + 1
+
+
+def merge_process_stats(target: dict, source: dict):
+    """合并处理统计（独立推理进程返回的统计并入任务）"""
+    for name, bucket in source.get('buckets', {}).items():
+        merged = target.setdefault('buckets', {}).setdefault(name, {'images': 0, 'seconds': 0.0})
+        merged['images'] += bucket['images']
+        merged['seconds'] += bucket['seconds']
+    if 'tag_diff' in source:
+        diff = target.setdefault('tag_diff', {'changed': 0, 'unchanged': 0, 'added': {}, 'removed': {}})
+        diff['changed'] += source['tag_diff']['changed']
+        diff['unchanged'] += source['tag_diff']['unchanged']
+        for key in ('added', 'removed'):
+            for tag, count in source['tag_diff'][key].items():
+                diff[key][tag] = diff[key].get(tag, 0) + count
+
+
+def format_tag_diff(diff: dict, top: int = 20) -> str:
+    """差异重新打标的汇总：改写/未变化的文件数和新增/删除次数最多的标签"""
+    def top_tags(counts: Dict[str, int]) -> str:
+        return ', '.join(f'{tag} ({count})' for tag, count in sorted(counts.items(), key=lambda item: -item[1])[:top])
+    return state.t('tag_diff_summary', changed=diff['changed'], unchanged=diff['unchanged'],
+                   added=top_tags(diff['added']) or '-', removed=top_tags(diff['removed']) or '-')
+
+
+def format_bucket_stats(stats: dict) -> str:
+    """每个尺寸分组的图片数和单线程预处理速度"""
+    parts = []
+    for name, _ in SIZE_BUCKETS:
+        bucket = stats.get('buckets', {}).get(name)
+        if bucket and bucket['images']:
+            rate = bucket['images'] / bucket['seconds'] if bucket['seconds'] > 0 else 0.0
+            parts.append(state.t('bucket_stat', bucket=name, images=bucket['images'], speed=rate))
+    return ', '.join(parts)
+
+
+# ============ 自动调优 ============
+
+TUNE_BATCH_SIZES = (1, 2, 4, 8, 16, 32)
+TUNE_WORKER_COUNTS = (1, 2, 4, 8, 16)
+TUNE_TRIAL_SECONDS = 1.0  # 每个配置的测量时长
+TUNE_SAMPLE_IMAGES = 16  # 用于测量预处理速度的图片数
+
+
+try:
+    import psutil
+except ImportError:  # 未安装 psutil 时按平台读取
+    psutil = None
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    """Windows PROCESS_MEMORY_COUNTERS"""
+    _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+        [(name, ctypes.c_size_t) for name in (
+            'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+            'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+
+def _rss_mb() -> Optional[float]:
+    """当前进程的常驻内存（MB）：psutil，或 Windows 工作集 / Linux /proc，都不可用时返回 None"""
+    try:
+        if psutil is not None:
+            return psutil.Process().memory_info().rss / 1024 / 1024
+        if sys.platform == 'win32':
+            counters = _ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(
+                    ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                return None
+            return counters.WorkingSetSize / 1024 / 1024
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _measure_throughput(func, items_per_call: int) -> float:
+    """重复执行 func 至少 TUNE_TRIAL_SECONDS 秒（不少于 3 次），返回每秒处理的图片数"""
+    func()  # 预热
+    runs = 0
+    started = time.perf_counter()
+    while runs < 3 or time.perf_counter() - started < TUNE_TRIAL_SECONDS:
+        func()
+        runs += 1
+    return runs * items_per_call / (time.perf_counter() - started)
+
+
+def autotune_model(model_name: str, sample_paths: Optional[List[str]] = None,
+                   memory_limit_mb: Optional[float] = None, progress=None) -> dict:
+    """对模型做一次简短的校准，搜索 ORT 线程数、批大小和预处理线程数
     
-    if state.is_processing:
-        ui.notify(state.t('processing_in_progress'), type='warning')
-        return
+    依次确定：批大小为 4 时吞吐最高的 intra-op 线程数 → 该线程数下内存不超过
+    memory_limit_mb 的最佳批大小 → 能跟上推理速度的最少预处理线程数（需要 sample_paths）。
+    无法读取进程内存时按输入和输出张量大小估算内存，结果中 memory_estimated 为 True。
+    结果按模型和主机指纹保存到 config.json，之后 start_processing 自动使用。
+    progress(message) 用于报告进度。
+    """
+    report = progress or (lambda message: print(f'[tune] {message}'))
+    model_path = os.path.join(get_model_dir(model_name), "model.onnx")
+    if get_cached_model(model_name)[0] is None:
+        raise RuntimeError("模型加载失败")
+    if memory_limit_mb is None:
+        memory_limit_mb = get_memory_settings()['budget_mb']
+    cpu_count = os.cpu_count() or 1
     
-    state.is_processing = True
-    progress_bar.set_visibility(True)
-    status_output.set_visibility(True)
-    status_output.value = ''
+    # 有图片时用真实图片测量，否则用随机数据
+    samples = []
+    for path in (sample_paths or [])[:TUNE_SAMPLE_IMAGES]:
+        image_array, _ = preprocess_image_guarded(path)
+        if image_array is not None:
+            samples.append(image_array)
+    sample_batch = (np.concatenate(samples, axis=0) if samples else
+                    np.random.default_rng(0).uniform(0, 255, (4, 448, 448, 3)).astype(np.float32))
     
-    # 初始化左侧进度信息框
-    progress_info.set_value(state.t('processing_started'))
-    ui.update(progress_info)
+    def make_batch(batch_size: int) -> np.ndarray:
+        repeats = -(-batch_size // len(sample_batch))
+        return np.ascontiguousarray(np.concatenate([sample_batch] * repeats, axis=0)[:batch_size])
     
-    model = model_select.value
-    threshold = threshold_slider.value
-    output_dir = output_input.value or DEFAULT_OUTPUT_DIR
-    print(f"[DEBUG] Output directory: {output_dir}")
+    def make_session(threads: int) -> TaggerSession:
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        return TaggerSession(ort.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider']))
     
-    results = []
-    total = len(state.image_paths)
-    processed_count = 0  # 实际处理的图片数（不含跳过）
+    # 1. ORT intra-op 线程数
+    best_threads, best_rate = cpu_count, 0.0
+    for threads in sorted({cpu_count, max(1, cpu_count // 2), max(1, cpu_count // 4)}, reverse=True):
+        batch = make_batch(4)
+        session = make_session(threads)
+        rate = _measure_throughput(lambda: session.run(batch), 4)
+        report(f'threads={threads} batch=4: {rate:.1f} img/s')
+        if rate > best_rate:
+            best_threads, best_rate = threads, rate
+        del session
     
-    for idx, image_path in enumerate(state.image_paths):
-        # 更新进度
-        progress = (idx + 1) / total
-        progress_bar.value = progress
-        
-        image_name = os.path.basename(image_path)
-        
-        print(f"[DEBUG] Processing {image_name}")
-        
-        # 在后台线程中处理图片，避免阻塞 UI
-        success, msg = await process_single_image(image_path, model, threshold, output_dir, state.current_lang)
-        
-        # 如果成功处理（不是跳过），增加计数
-        if success and '已跳过' not in msg:
-            processed_count += 1
-        
-        # 构建当前图片的处理结果
-        current_result = f'[{idx + 1}/{total}] {image_name}'
-        if not success:
-            current_result += f"\n  ❌ {state.t('failed')}: {msg}"
-        elif '已跳过' in msg or 'Skipped' in msg or 'exists' in msg:
-            current_result += f"\n  ⏭️ {msg}"
-        elif '重新打标' in msg or 'Retagged' in msg:
-            current_result += f"\n  🔄 {msg}"
+    # 2. 批大小：吞吐明显下降或超出内存限制时停止
+    session = make_session(best_threads)
+    baseline_mb = _rss_mb()
+    best_batch, best_rate, peak_mb = 1, 0.0, 0.0
+    for batch_size in TUNE_BATCH_SIZES:
+        batch = make_batch(batch_size)
+        rate = _measure_throughput(lambda: session.run(batch), batch_size)
+        current_mb = _rss_mb() if baseline_mb is not None else None
+        if current_mb is not None:
+            used_mb = current_mb - baseline_mb
         else:
-            current_result += f"\n  ✅ {state.t('completed')}: {os.path.basename(msg)}"
-        
-        # 添加到结果列表
-        results.append(current_result)
-        
-        # 更新显示 - 包含所有已处理图片的结果
-        current_display = '\n\n'.join(results)
-        status_output.set_value(current_display)
-        progress_info.set_value(current_display)
-        ui.update(progress_info)
-    
-    # 添加完成信息
-    completed_count = len([r for r in results if '✅' in r or 'Completed' in r])
-    skipped_count = len([r for r in results if '⏭️' in r or 'Skipped' in r])
-    failed_count = len([r for r in results if '❌' in r or 'Failed' in r])
-    final_display = '\n\n'.join(results) + '\n\n' + state.t('final_result', completed=completed_count, skipped=skipped_count, failed=failed_count)
-    status_output.set_value(final_display)
-    progress_info.set_value(final_display)
-    ui.update(progress_info)
+            # 估算：调用方的 NHWC 批次、NCHW 输入缓冲区和输出缓冲区（不含 ORT 内部的中间结果）
+            used_mb = (batch.nbytes * 2 + sum(output.nbytes for output in session.run(batch))) / 1024 / 1024
+        report(f'threads={best_threads} batch={batch_size}: {rate:.1f} img/s, +{used_mb:.0f} MB'
+               + ('' if current_mb is not None else ' (estimated)'))
+        if used_mb > memory_limit_mb:
+            break
+        if rate > best_rate:
+            best_batch, best_rate, peak_mb = batch_size, rate, used_mb
+        elif rate < best_rate * 0.9:
+            break
+    del session
     
-    progress_bar.set_visibility(False)
-    # 处理完成后5秒隐藏右侧状态输出
-    ui.timer(5.0, lambda: status_output.set_visibility(False), once=True)
-    state.is_processing = False
+    # 3. 预处理线程数：取能跟上推理速度的最少线程，否则取最快的
+    workers, preprocess_rate = PREPROCESS_WORKERS, None
+    valid_paths = [path for path in (sample_paths or [])[:TUNE_SAMPLE_IMAGES] if path.lower().endswith(IMAGE_EXTENSIONS)]
+    if valid_paths:
+        best_workers, best_worker_rate = 1, 0.0
+        for count in (c for c in TUNE_WORKER_COUNTS if c <= max(1, cpu_count)):
+            with ThreadPoolExecutor(max_workers=count) as pool:
+                rate = _measure_throughput(lambda: list(pool.map(preprocess_image_guarded, valid_paths)), len(valid_paths))
+            report(f'workers={count}: {rate:.1f} img/s')
+            if rate > best_worker_rate:
+                best_workers, best_worker_rate = count, rate
+            if rate >= best_rate:
+                best_workers, best_worker_rate = count, rate
+                break
+        workers, preprocess_rate = best_workers, best_worker_rate
     
-    ui.notify(state.t('processing_completed'), type='positive')
+    result = {
+        'batch_size': best_batch,
+        'workers': workers,
+        'intra_op_threads': best_threads,
+        'images_per_sec': round(min(best_rate, preprocess_rate) if preprocess_rate else best_rate, 1),
+        'memory_mb': round(peak_mb),
+        'memory_estimated': baseline_mb is None,
+        'tuned_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    set_tuning(model_name, result)
+    # 丢弃已缓存的会话，下次使用时按新的线程数加载
+    with _model_cache_lock:
+        state.model_sessions.pop(model_name, None)
+    return result
 
 
-# ============ 主程序 ============
+async def run_autotune():
+    """界面上的调优按钮：对当前模型校准，优先使用已添加的图片"""
+    model_name = model_select.value
+    if not model_name:
+        ui.notify(state.t('select_model_first'), type='warning')
+        return
+    button = state.ui_refs['tune_button']
+    button.disable()
+    ui.notify(state.t('tuning', model=model_name), type='info')
+    try:
+        samples = [item.path for item in state.catalog.page(0, TUNE_SAMPLE_IMAGES * 4) if item.path.lower().endswith(IMAGE_EXTENSIONS)]
+        result = await run.io_bound(autotune_model, model_name, samples)
+        ui.notify(state.t('tune_done', **result), type='positive')
+    except Exception as e:
+        ui.notify(state.t('tune_failed', error=str(e)), type='negative')
+    finally:
+        button.enable()
+        update_tuning_label()
 
-@ui.page('/')
-def main_page():
-    """主页面"""
-    # 添加 Tailwind CSS
-    ui.add_head_html('''
-        <script src="https://cdn.tailwindcss.com"></script>
-        <style>
-            .gradient-text {
-                background: linear-gradient(to right, #3b82f6, #8b5cf6);
-                -webkit-background-clip: text;
-                -webkit-text-fill-color: transparent;
-            }
-            /* 引导词文本颜色 - 黑色 */
-            .prompt-textarea .q-field__native {
-                color: #000000 !important;
-                font-size: 14px !important;
-                line-height: 1.5 !important;
-            }
-            .prompt-textarea .q-field__control {
-                background: white !important;
-            }
-        </style>
-    ''')
+
+def update_tuning_label():
+    """显示当前模型在本机的调优结果"""
+    if 'tuning_label' not in state.ui_refs:
+        return
+    tuning = get_tuning(model_select.value) if model_select.value else None
+    state.ui_refs['tuning_label'].set_text(state.t('tune_info', **tuning) if tuning else state.t('not_tuned'))
+
+
+# ============ 精度对比 ============
+
+PARITY_MAX_DEVIATION = 0.01  # 默认容差：单个分数的最大偏差
+PARITY_MIN_JACCARD = 0.95  # 默认容差：每张图片标签集合的最小 Jaccard 相似度
+
+
+def load_reference_model(model_name: str) -> Tuple[Optional[ort.InferenceSession], Optional[Tuple[List[str], List[str]]]]:
+    """参考配置使用的模型：默认 SessionOptions 的普通 InferenceSession，
+    不使用调优线程数和 IO binding，也不与打标路径共用缓存的会话"""
+    model_path = os.path.join(get_model_dir(model_name), "model.onnx")
+    tags_path = os.path.join(get_model_dir(model_name), "selected_tags.csv")
+    if (not os.path.exists(model_path) or not os.path.exists(tags_path)) and not download_model(model_name):
+        return None, None
+    try:
+        session = ort.InferenceSession(model_path, ort.SessionOptions(), providers=['CPUExecutionProvider'])
+        return session, load_tag_data(tags_path)
+    except Exception as e:
+        print(f"加载参考模型失败: {e}")
+        return None, None
+
+
+def reference_scores(image_path: str, session: ort.InferenceSession) -> Optional[np.ndarray]:
+    """参考配置：preprocess_image + 单张 fp32 session.run（与 get_image_tags 相同），返回 general 和 character 分数"""
+    image_array = preprocess_image(image_path)
+    if image_array is None:
+        return None
+    input_meta = session.get_inputs()[0]
+    if len(input_meta.shape) == 4 and input_meta.shape[1] == 3:  # CHW format
+        image_array = image_array.transpose(0, 3, 1, 2)
+    outputs = session.run(None, {input_meta.name: image_array})
+    if len(outputs) < 2:
+        return outputs[0][0]
+    return np.concatenate([outputs[0][0], outputs[1][0]])
+
+
+def candidate_scores(image_paths: List[str], options: 'TaggingOptions') -> List[Optional[np.ndarray]]:
+    """候选配置：与 process_image_batch 相同的预处理和批量推理路径"""
+    scores: List[Optional[np.ndarray]] = []
+    pool = get_preprocess_pool(options.workers)
+    for start in range(0, len(image_paths), options.batch_size):
+        preprocessed = list(pool.map(preprocess_image_guarded, image_paths[start:start + options.batch_size]))
+        arrays = [image_array for image_array, _ in preprocessed if image_array is not None]
+        rows = iter(())
+        if arrays:
+            general_output, character_output, _ = infer_tag_scores(
+                options.model, np.concatenate(arrays, axis=0), options.ensemble_mode, options.ensemble_weights)
+            rows = iter([general_output[i] if character_output is None else
+                         np.concatenate([general_output[i], character_output[i]]) for i in range(len(arrays))])
+        scores.extend(next(rows) if image_array is not None else None for image_array, _ in preprocessed)
+    return scores
+
+
+def run_parity(image_paths: List[str], reference_model: str, candidate: 'TaggingOptions',
+               max_deviation: float = PARITY_MAX_DEVIATION, min_jaccard: float = PARITY_MIN_JACCARD,
+               intra_op_threads: Optional[int] = None) -> dict:
+    """在同一组图片上比较参考配置和候选配置
     
-    create_header()
+    返回报告：最大/平均分数偏差、每张图片标签集合的 Jaccard 相似度、标签发生变化的图片，
+    以及是否在容差内（passed）。两种配置必须使用相同的标签表。
+    intra_op_threads 指定候选配置的推理线程数（不指定时使用本机调优结果）。
+    """
+    reference_session, tag_data = load_reference_model(reference_model)
+    candidate_models = [candidate.model] if isinstance(candidate.model, str) else list(candidate.model)
+    if intra_op_threads:
+        # 按指定的线程数重新加载候选模型，替换缓存中的会话
+        for model_name in candidate_models:
+            session, model_tag_data = load_wd14_model(model_name, intra_op_threads)
+            if session is not None:
+                with _model_cache_lock:
+                    state.model_sessions[model_name], state.tag_data[model_name] = session, model_tag_data
+    candidate_tag_data = get_cached_model(candidate_models[0])[1]
+    if tag_data is None or candidate_tag_data is None:
+        raise RuntimeError("模型加载失败")
+    if candidate_tag_data != tag_data:
+        raise ValueError("参考模型和候选模型必须使用相同的标签表 (selected_tags.csv)")
     
-    # 主布局：左右分栏
-    with ui.row().classes('w-full p-4 gap-4'):
-        # 左侧区域（图片预览区，自适应宽度）
-        with ui.column().classes('flex-grow gap-3'):
-            create_left_panel()
-        
-        # 右侧区域（功能按钮区，固定宽度 320px）
-        with ui.column().classes('w-80 gap-3 flex-shrink-0'):
-            create_right_panel()
+    def tag_set(scores: np.ndarray) -> set:
+        general_size = 4 + len(tag_data[0])
+        character = scores[general_size:] if len(scores) > general_size else None
+        return {tag for tag, _ in scores_to_tags(scores[:general_size], character, tag_data, candidate.threshold)}
+    
+    report = {'images': 0, 'max_deviation': 0.0, 'mean_deviation': 0.0, 'mean_jaccard': 1.0,
+              'min_jaccard': 1.0, 'flipped': [], 'failed': []}
+    deviations, jaccards = [], []
+    for image_path, candidate_row in zip(image_paths, candidate_scores(image_paths, candidate)):
+        reference_row = reference_scores(image_path, reference_session)
+        if reference_row is None or candidate_row is None or reference_row.shape != candidate_row.shape:
+            report['failed'].append(image_path)
+            continue
+        difference = np.abs(reference_row - candidate_row)
+        deviations.append((float(difference.max()), float(difference.mean())))
+        reference_tags, candidate_tags = tag_set(reference_row), tag_set(candidate_row)
+        union = reference_tags | candidate_tags
+        jaccard = len(reference_tags & candidate_tags) / len(union) if union else 1.0
+        jaccards.append(jaccard)
+        if reference_tags != candidate_tags:
+            report['flipped'].append({'image': image_path, 'jaccard': round(jaccard, 4),
+                                      'added': sorted(candidate_tags - reference_tags),
+                                      'removed': sorted(reference_tags - candidate_tags)})
+    
+    report['images'] = len(jaccards)
+    if jaccards:
+        report['max_deviation'] = max(d for d, _ in deviations)
+        report['mean_deviation'] = float(np.mean([d for _, d in deviations]))
+        report['mean_jaccard'] = float(np.mean(jaccards))
+        report['min_jaccard'] = min(jaccards)
+    report['passed'] = (bool(jaccards) and not report['failed'] and report['max_deviation'] <= max_deviation
+                        and report['min_jaccard'] >= min_jaccard)
+    return report
 
 
-if __name__ in {'__main__', '__mp_main__'}:
-    import webbrowser
+def format_parity_report(report: dict) -> str:
+    """把对比报告格式化为文本"""
+    lines = [f"图片: {report['images']}，失败: {len(report['failed'])}",
+             f"分数偏差: 最大 {report['max_deviation']:.6f}，平均 {report['mean_deviation']:.6f}",
+             f"标签 Jaccard: 平均 {report['mean_jaccard']:.4f}，最小 {report['min_jaccard']:.4f}",
+             f"标签变化的图片: {len(report['flipped'])}"]
+    for item in report['flipped']:
+        lines.append(f"  {item['image']} (J={item['jaccard']}) +{item['added']} -{item['removed']}")
+    for image_path in report['failed']:
+        lines.append(f"  失败: {image_path}")
+    lines.append('PASS' if report['passed'] else 'FAIL')
+    return '\n'.join(lines)
+
+
+def build_standin_model(model_dir: str, general_count: int = 64, character_count: int = 16,
+                        channels_first: bool = False, seed: int = 0):
+    """生成一个很小的替身 ONNX 模型和对应的 selected_tags.csv，用于自动化测试中的精度对比
+    
+    模型对输入做全局均值后接一个随机线性层和 sigmoid，输出布局与 WD v3 一致
+    （4 个评分 + general 标签，character 标签为第二个输出）。需要安装 onnx。
+    """
+    try:
+        import onnx
+        from onnx import helper, numpy_helper, TensorProto
+    except ImportError:
+        raise RuntimeError("生成替身模型需要安装 onnx: pip install onnx")
+    
+    rng = np.random.default_rng(seed)
+    general_size = 4 + general_count
+    # 各通道均值约为 0~255，缩放后让分数分布在阈值两侧
+    weights = rng.normal(size=(3, general_size + character_count)).astype(np.float32) / 64
+    input_shape = ['batch', 3, 448, 448] if channels_first else ['batch', 448, 448, 3]
+    nodes = [
+        helper.make_node('ReduceMean', ['input', 'axes'], ['mean'], keepdims=0),
+        helper.make_node('Sub', ['mean', 'center'], ['centered']),
+        helper.make_node('MatMul', ['centered', 'weights'], ['logits']),
+        helper.make_node('Sigmoid', ['logits'], ['scores']),
+        helper.make_node('Split', ['scores', 'split'], ['output', 'character'], axis=1),
+    ]
+    initializers = [
+        numpy_helper.from_array(np.array([2, 3] if channels_first else [1, 2], dtype=np.int64), 'axes'),
+        numpy_helper.from_array(np.full(3, 128, dtype=np.float32), 'center'),
+        numpy_helper.from_array(weights, 'weights'),
+        numpy_helper.from_array(np.array([general_size, character_count], dtype=np.int64), 'split'),
+    ]
+    graph = helper.make_graph(
+        nodes, 'wd14_standin', [helper.make_tensor_value_info('input', TensorProto.FLOAT, input_shape)],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['batch', general_size]),
+         helper.make_tensor_value_info('character', TensorProto.FLOAT, ['batch', character_count])],
+        initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 18)])
+    model.ir_version = 9
+    
+    os.makedirs(model_dir, exist_ok=True)
+    onnx.save(model, os.path.join(model_dir, 'model.onnx'))
+    with open(os.path.join(model_dir, 'selected_tags.csv'), 'w', encoding='utf-8') as f:
+        f.write('tag_id,name,category,count\n')
+        for i, rating in enumerate(('general', 'sensitive', 'questionable', 'explicit')):
+            f.write(f'{9999999 - i},{rating},9,0\n')
+        for i in range(general_count):
+            f.write(f'{i},general_tag_{i},0,0\n')
+        for i in range(character_count):
+            f.write(f'{general_count + i},character_{i},4,0\n')
+
+
+# ============ 标签索引 ============
+
+TAG_STATS_TOP = 50  # 标签统计显示的标签数
+
+
+class TagIndex:
+    """标签倒排索引：标签 -> 图片编号的有序 int32 数组，随打标结果增量更新
+    
+    查询语法：逗号分隔的条件同时满足，`-标签` 或 `NOT 标签` 表示排除，
+    `a | b` 或 `a OR b` 表示任一，例如 `1girl, -monochrome, red_hair | blue_hair`。
+    每张图片可附带调用方的编号 key（画廊传入图片目录的 id），query_keys 直接返回这些编号，
+    不必再按路径到图片目录中逐个查找。
+    """
+    def __init__(self):
+        self._image_ids: Dict[str, int] = {}  # 仅包含仍在索引中的图片，删除后编号不复用
+        self._paths: List[str] = []
+        self._image_tags: List[Tuple[int, ...]] = []  # 每张图片当前的标签编号
+        self._keys = np.full(16, -1, dtype=np.int64)  # 图片编号 -> 调用方编号，-1 表示没有
+        self._children: Dict[str, set] = {}  # 压缩包路径 -> 其成员路径，删除压缩包时一起删除
+        self._tag_ids: Dict[str, int] = {}
+        self._tag_names: List[str] = []
+        self._postings: List[np.ndarray] = []  # 预留容量的缓冲区，前 _lengths[t] 个有效
+        self._lengths: List[int] = []
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._image_ids)
+    
+    def _tag_id(self, tag: str) -> int:
+        tag_id = self._tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self._tag_names)
+            self._tag_ids[tag] = tag_id
+            self._tag_names.append(tag)
+            self._postings.append(np.empty(16, dtype=np.int32))
+            self._lengths.append(0)
+        return tag_id
+    
+    def _add(self, tag_id: int, image_id: int):
+        buffer, length = self._postings[tag_id], self._lengths[tag_id]
+        if length == len(buffer):
+            buffer = np.resize(buffer, length * 2)
+            self._postings[tag_id] = buffer
+        if length == 0 or buffer[length - 1] < image_id:
+            buffer[length] = image_id  # 新图片编号递增，通常直接追加
+        else:
+            pos = np.searchsorted(buffer[:length], image_id)
+            buffer[pos + 1:length + 1] = buffer[pos:length].copy()
+            buffer[pos] = image_id
+        self._lengths[tag_id] = length + 1
+    
+    def _remove(self, tag_id: int, image_id: int):
+        buffer, length = self._postings[tag_id], self._lengths[tag_id]
+        pos = np.searchsorted(buffer[:length], image_id)
+        if pos < length and buffer[pos] == image_id:
+            buffer[pos:length - 1] = buffer[pos + 1:length].copy()
+            self._lengths[tag_id] = length - 1
+    
+    def update(self, image_path: str, tags: List[str], key: Optional[int] = None, parent: Optional[str] = None):
+        """写入或替换一张图片的标签，parent 为成员所在的压缩包"""
+        with self._lock:
+            if parent is not None:
+                self._children.setdefault(parent, set()).add(image_path)
+            image_id = self._image_ids.get(image_path)
+            if image_id is None:
+                image_id = len(self._paths)
+                self._image_ids[image_path] = image_id
+                self._paths.append(image_path)
+                self._image_tags.append(())
+                if image_id == len(self._keys):
+                    self._keys = np.concatenate([self._keys, np.full(len(self._keys), -1, dtype=np.int64)])
+            self._keys[image_id] = -1 if key is None else key
+            old = set(self._image_tags[image_id])
+            new = {self._tag_id(tag) for tag in tags if tag}
+            for tag_id in old - new:
+                self._remove(tag_id, image_id)
+            for tag_id in sorted(new - old):
+                self._add(tag_id, image_id)
+            self._image_tags[image_id] = tuple(new)
+    
+    def update_from_txt(self, image_path: str, txt_path: str, key: Optional[int] = None,
+                        parent: Optional[str] = None):
+        """从打标输出的 txt 读取标签写入索引（不是 UTF-8 的 txt，如 GBK 编码，无法解码的字节会被替换）"""
+        try:
+            with open(txt_path, 'r', encoding='utf-8', errors='replace') as f:
+                content = f.read()
+        except OSError:
+            return
+        self.update(image_path, [tag.strip() for tag in content.split(',')], key, parent)
+    
+    def remove(self, image_paths):
+        """从索引中删除图片（如从图片列表中移除后），压缩包的成员一起删除"""
+        with self._lock:
+            image_paths = list(image_paths)
+            for image_path in list(image_paths):
+                image_paths.extend(self._children.pop(image_path, ()))
+            for image_path in image_paths:
+                image_id = self._image_ids.pop(image_path, None)
+                if image_id is None:
+                    continue
+                for tag_id in self._image_tags[image_id]:
+                    self._remove(tag_id, image_id)
+                self._image_tags[image_id] = ()
+                self._keys[image_id] = -1
+    
+    def clear(self):
+        with self._lock:
+            self._image_ids.clear()
+            self._paths.clear()
+            self._image_tags.clear()
+            self._keys = np.full(16, -1, dtype=np.int64)
+            self._children.clear()
+            for tag_id in range(len(self._lengths)):
+                self._lengths[tag_id] = 0
+    
+    def set_keys(self, key_of: Callable[[str], Optional[int]]):
+        """重新设置所有图片的调用方编号（如图片目录重新编号后）"""
+        with self._lock:
+            for image_path, image_id in self._image_ids.items():
+                key = key_of(image_path)
+                self._keys[image_id] = -1 if key is None else key
+    
+    def _posting(self, tag: str) -> np.ndarray:
+        tag_id = self._tag_ids.get(tag.strip())
+        if tag_id is None:
+            tag_id = self._tag_ids.get(tag.strip().replace(' ', '_'))
+        if tag_id is None:
+            return np.empty(0, dtype=np.int32)
+        return self._postings[tag_id][:self._lengths[tag_id]]
+    
+    def query_ids(self, expression: str) -> np.ndarray:
+        """执行查询，返回匹配的图片编号（有序）"""
+        with self._lock:
+            positives, negatives = [], []
+            for term in expression.replace('，', ',').split(','):
+                term = term.strip()
+                if not term:
+                    continue
+                negate = term.startswith('-') or term.upper().startswith('NOT ')
+                if negate:
+                    term = term[1:] if term.startswith('-') else term[4:]
+                alternatives = [t for t in term.replace(' OR ', '|').split('|') if t.strip()]
+                ids = self._posting(alternatives[0]) if alternatives else np.empty(0, dtype=np.int32)
+                for alternative in alternatives[1:]:
+                    ids = np.union1d(ids, self._posting(alternative))
+                (negatives if negate else positives).append(ids)
+            
+            if positives:
+                # 从最短的数组开始求交集
+                positives.sort(key=len)
+                result = positives[0]
+                for ids in positives[1:]:
+                    if not len(result):
+                        break
+                    result = np.intersect1d(result, ids, assume_unique=True)
+            else:
+                result = np.sort(np.fromiter(self._image_ids.values(), dtype=np.int32, count=len(self._image_ids)))
+            for ids in negatives:
+                result = np.setdiff1d(result, ids, assume_unique=True)
+            # 返回副本，避免之后的更新改动结果
+            return np.array(result, dtype=np.int32)
+    
+    def query(self, expression: str) -> List[str]:
+        """执行查询，返回匹配的图片路径"""
+        ids = self.query_ids(expression)
+        return [self._paths[i] for i in ids]
+    
+    def query_keys(self, expression: str) -> np.ndarray:
+        """执行查询，返回匹配图片的调用方编号（升序、去重，不含没有编号的图片）"""
+        ids = self.query_ids(expression)
+        with self._lock:
+            keys = self._keys[ids]
+        return np.unique(keys[keys >= 0])  # 同一压缩包的多个成员对应同一个编号
+    
+    def frequencies(self, top: Optional[int] = None) -> List[Tuple[str, int]]:
+        """全数据集的标签频次，从高到低"""
+        with self._lock:
+            counts = np.asarray(self._lengths, dtype=np.int64)
+            order = np.argsort(-counts, kind='stable')
+            if top is not None:
+                order = order[:top]
+            return [(self._tag_names[i], int(counts[i])) for i in order if counts[i] > 0]
+
+
+tag_index = TagIndex()
+
+
+# ============ 任务调度 ============
+
+JOB_BATCH_SIZE = 8  # 每批推理的图片数
+JOB_WINDOW_BATCHES = 4  # 每次交给 process_image_batch 的推理批数，暂停/取消在两次之间生效
+JOB_STATUS_KEYS = {
+    'queued': 'job_queued_status',
+    'running': 'job_running',
+    'paused': 'job_paused',
+    'cancelled': 'job_cancelled_status',
+    'failed': 'job_failed_status',
+    'completed': 'job_completed',
+}
+
+
+class TaggingJob:
+    """一次打标任务：拥有独立的图片集合和处理参数（模型、阈值、输出目录等）
+    
+    图片来自 image_paths 列表，或者（传入 catalog 时）图片目录中创建任务时已有的待处理图片，
+    后者按窗口从目录分页读取，不复制整个列表。
+    """
+    _next_id = 1
+    
+    def __init__(self, image_paths: List[str], options: TaggingOptions, priority: int = 0,
+                 catalog: Optional[ImageCatalog] = None):
+        self.id = TaggingJob._next_id
+        TaggingJob._next_id += 1
+        self.image_paths = list(image_paths)
+        self.catalog = catalog
+        if catalog is not None:
+            self._catalog_total = catalog.count(status='pending')
+            self._catalog_cursor = 0  # 已读取到的最后一个图片 id
+            self._catalog_last_id = catalog.last_id()  # 之后添加的图片不属于本任务
+        self.discovering = False  # 为 True 时图片仍在陆续加入（见 tag_folder），处理完已有图片后继续等待
+        self.options = options
+        self.priority = priority
+        self.status = 'queued'  # queued / running / paused / cancelled / failed / completed
+        self.error: Optional[str] = None  # 任务出错停止时的错误信息
+        self.next_index = 0  # 下一张待处理图片，暂停后从这里继续
+        self.counts = {'completed': 0, 'skipped': 0, 'failed': 0}
+        self.results: List[str] = []
+        self.throttled: List[Tuple[str, str]] = []  # (图片路径, 限流说明)
+        self.active_seconds = 0.0  # 实际运行时长（不含排队和暂停）
+        self.stats: dict = {}  # 处理统计：尺寸分组（record_bucket_stats）和标签差异（record_tag_diff）
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+    
+    @property
+    def total(self) -> int:
+        return len(self.image_paths) if self.catalog is None else self._catalog_total
+    
+    def next_window(self, size: int) -> List[str]:
+        """取出接下来最多 size 张待处理图片"""
+        if self.catalog is None:
+            return self.image_paths[self.next_index:self.next_index + size]
+        items = [item for item in self.catalog.page(0, size, status='pending', after=self._catalog_cursor)
+                 if item.id <= self._catalog_last_id]
+        if items:
+            self._catalog_cursor = items[-1].id
+        return [item.path for item in items]
+    
+    @property
+    def done(self) -> int:
+        return self.next_index
+    
+    @property
+    def throughput(self) -> float:
+        """每秒处理图片数"""
+        return self.done / self.active_seconds if self.active_seconds > 0 else 0.0
+    
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ('completed', 'cancelled', 'failed')
+    
+    def record(self, image_path: str, status: str, msg: str, note: str = ''):
+        """记录单张图片的处理结果"""
+        index = len(self.results) + 1
+        current_result = f'[{index}/{self.total}] {os.path.basename(image_path)}'
+        if status == 'failed':
+            self.counts['failed'] += 1
+            current_result += f"\n  ❌ {state.t('failed')}: {msg}"
+        elif status in ('skipped', 'unchanged'):
+            self.counts['skipped'] += 1
+            current_result += f"\n  ⏭️ {msg}"
+        elif status == 'retagged':
+            self.counts['completed'] += 1
+            current_result += f"\n  🔄 {msg}"
+        elif status == 'archive':
+            # 压缩包的汇总信息（各成员的完成/跳过/失败数），不是 txt 路径
+            self.counts['completed'] += 1
+            current_result += f"\n  ✅ {msg}"
+        else:
+            self.counts['completed'] += 1
+            current_result += f"\n  ✅ {state.t('completed')}: {os.path.basename(msg)}"
+        if note:
+            self.throttled.append((image_path, note))
+            current_result += f"\n  🐢 {state.t('memory_' + note)}"
+        self.results.append(current_result)
+
+
+class JobScheduler:
+    """按优先级依次执行打标任务，支持排队、暂停、恢复和取消
+    
+    同一时间只运行一个任务；每批处理结束后检查暂停/取消请求，
+    若有更高优先级的任务排队则让出执行权，已完成的图片不会丢失。
+    """
+    def __init__(self):
+        self.jobs: Dict[int, TaggingJob] = {}
+        self.current: Optional[TaggingJob] = None
+        self._queue: List[Tuple[int, int]] = []  # (-优先级, 任务号)，任务号保证同优先级先进先出
+        self._runner: Optional[asyncio.Task] = None
+        self.on_update = None  # 每批完成后回调 on_update(job)
+        self.on_finish = None  # 任务结束（完成/取消）时回调 on_finish(job)
+    
+    def submit(self, job: TaggingJob) -> TaggingJob:
+        """提交任务，必要时启动调度协程"""
+        self.jobs[job.id] = job
+        self._enqueue(job)
+        if self._runner is None or self._runner.done():
+            self._runner = background_tasks.create(self._run(), name='wd14-job-scheduler')
+        return job
+    
+    def _enqueue(self, job: TaggingJob):
+        job.status = 'queued'
+        heapq.heappush(self._queue, (-job.priority, job.id))
+    
+    def pause(self, job_id: int):
+        job = self.jobs.get(job_id)
+        if job and job.status in ('queued', 'running'):
+            # 运行中的任务在当前批次结束后暂停
+            job.status = 'paused'
+    
+    def resume(self, job_id: int):
+        job = self.jobs.get(job_id)
+        if job and job.status == 'paused':
+            if job is self.current:
+                job.status = 'running'  # 还没来得及让出，直接继续
+            else:
+                self.submit(job)
+    
+    def cancel(self, job_id: int):
+        job = self.jobs.get(job_id)
+        if job and not job.is_finished:
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+            if job is not self.current and self.on_finish:
+                self.on_finish(job)
+    
+    def _pop_next(self) -> Optional[TaggingJob]:
+        while self._queue:
+            _, job_id = heapq.heappop(self._queue)
+            job = self.jobs[job_id]
+            if job.status == 'queued':
+                return job
+        return None
+    
+    def _has_higher_priority(self, job: TaggingJob) -> bool:
+        return any(-p > job.priority and self.jobs[i].status == 'queued' for p, i in self._queue)
+    
+    async def _run(self):
+        while True:
+            job = self._pop_next()
+            if job is None:
+                break
+            self.current = job
+            job.status = 'running'
+            try:
+                await self._run_job(job)
+            except Exception as e:
+                # 单个任务出错（如推理进程退出、读取结果失败）只停止该任务，继续处理队列中的其他任务
+                print(f"任务 #{job.id} 出错: {e}")
+                job.status = 'failed'
+                job.error = str(e)
+                job.finished_at = time.time()
+                if self.on_finish:
+                    self.on_finish(job)
+            finally:
+                self.current = None
+    
+    @staticmethod
+    def _index_archive(archive_path: str, options: TaggingOptions):
+        """压缩包成员的 txt 写入标签索引，成员记为 <压缩包路径>/<成员路径（不含扩展名）>，
+        编号为压缩包在图片目录中的 id，筛选时显示匹配成员所在的压缩包"""
+        output_root = archive_output_root(archive_path, options)
+        key = state.catalog.id_of(archive_path)
+        for dirpath, _, filenames in os.walk(output_root):
+            for filename in filenames:
+                if filename.endswith('.txt'):
+                    txt_path = os.path.join(dirpath, filename)
+                    member = os.path.splitext(os.path.relpath(txt_path, output_root))[0].replace(os.sep, '/')
+                    tag_index.update_from_txt(f'{archive_path}/{member}', txt_path, key, parent=archive_path)
+    
+    @staticmethod
+    def _index_results(batch: List[str], results: List[Tuple[str, str, str]], options: TaggingOptions):
+        for image_path, (status, _, _) in zip(batch, results):
+            if status == 'archive':
+                JobScheduler._index_archive(image_path, options)
+            elif status != 'failed':
+                tag_index.update_from_txt(image_path, get_txt_path(image_path, options.output_dir, **options.layout),
+                                          state.catalog.id_of(image_path))
+        # 同步图片目录中的处理状态
+        state.catalog.set_statuses([(image_path, 'failed' if status == 'failed' else 'tagged', msg)
+                                    for image_path, (status, msg, _) in zip(batch, results)])
+    
+    async def _run_job(self, job: TaggingJob):
+        while job.next_index < job.total or job.discovering:
+            if job.status == 'cancelled':
+                break
+            if job.status == 'paused':
+                return
+            if self._has_higher_priority(job):
+                # 让出给更高优先级的任务，稍后从断点继续
+                self._enqueue(job)
+                return
+            if job.discovering and job.total - job.next_index < job.options.batch_size:
+                # 文件夹仍在遍历中，等凑满一批再处理
+                await asyncio.sleep(0.1)
+                continue
+            
+            batch = job.next_window(job.options.batch_size * JOB_WINDOW_BATCHES)
+            if not batch:
+                break  # 图片在任务运行期间被移出了目录
+            started = time.monotonic()
+            process = inference_client.process_image_batch if inference_client else process_image_batch
+            results = await run.io_bound(process, batch, job.options, job.stats)
+            job.active_seconds += time.monotonic() - started
+            for image_path, (status, msg, note) in zip(batch, results):
+                job.record(image_path, status, msg, note)
+            # 打标结果写入标签索引（跳过的图片也读取已有 txt）
+            await run.io_bound(self._index_results, batch, results, job.options)
+            job.next_index += len(batch)
+            if self.on_update:
+                self.on_update(job)
+        
+        if job.status != 'cancelled':
+            job.status = 'completed'
+        job.finished_at = time.time()
+        if self.on_finish:
+            self.on_finish(job)
+
+
+scheduler = JobScheduler()
+
+
+def on_job_update(job: TaggingJob):
+    """任务进度回调：刷新进度条和进度信息"""
+    progress_bar.set_visibility(True)
+    status_output.set_visibility(True)
+    progress_bar.value = job.done / job.total if job.total else 1
+    current_display = '\n\n'.join(job.results)
+    status_output.set_value(current_display)
+    progress_info.set_value(current_display)
+    update_job_list()
+    update_tag_stats()
+    if state.gallery_filter:
+        update_gallery()
+
+
+def on_job_finish(job: TaggingJob):
+    """任务结束回调：显示最终统计"""
+    final_display = '\n\n'.join(job.results) + '\n\n' + state.t(
+        'final_result', completed=job.counts['completed'], skipped=job.counts['skipped'], failed=job.counts['failed'])
+    if job.stats.get('buckets'):
+        final_display += '\n' + state.t('bucket_summary', stats=format_bucket_stats(job.stats))
+    if job.stats.get('tag_diff'):
+        final_display += '\n' + format_tag_diff(job.stats['tag_diff'])
+    if job.throttled:
+        final_display += '\n' + state.t('memory_throttled_summary', count=len(job.throttled)) + '\n' + \
+            '\n'.join(f"  {os.path.basename(path)} ({state.t('memory_' + note)})" for path, note in job.throttled)
+    status_output.set_value(final_display)
+    progress_info.set_value(final_display)
+    update_job_list()
+    
+    if scheduler.current is None and not any(j.status == 'queued' for j in scheduler.jobs.values()):
+        progress_bar.set_visibility(False)
+        # 处理完成后5秒隐藏右侧状态输出
+        with status_output:
+            ui.timer(5.0, lambda: status_output.set_visibility(False), once=True)
+    with progress_info:
+        if job.status == 'failed':
+            ui.notify(state.t('job_failed', id=job.id, error=job.error), type='negative')
+        else:
+            key = 'job_cancelled' if job.status == 'cancelled' else 'processing_completed'
+            ui.notify(state.t(key, id=job.id), type='positive')
+
+
+scheduler.on_update = on_job_update
+scheduler.on_finish = on_job_finish
+
+
+def update_job_list():
+    """刷新任务列表"""
+    if 'job_list' not in globals() or job_list is None:
+        return
+    
+    job_list.clear()
+    jobs = sorted(scheduler.jobs.values(), key=lambda j: (j.is_finished, -j.priority, j.id))
+    with job_list:
+        if not jobs:
+            ui.label(state.t('no_jobs')).classes('text-sm text-gray-400')
+            return
+        for job in jobs:
+            with ui.row().classes('w-full items-center gap-2 text-sm'):
+                ui.label(state.t('job_summary', id=job.id, status=state.t(JOB_STATUS_KEYS[job.status]), model=job.options.model_label,
+                                 done=job.done, total=job.total, speed=job.throughput,
+                                 priority=job.priority)).classes('flex-grow font-mono')
+                if job.status in ('queued', 'running'):
+                    ui.button(state.t('pause'), on_click=lambda j=job: (scheduler.pause(j.id), update_job_list())).props('flat dense')
+                if job.status == 'paused':
+                    ui.button(state.t('resume'), on_click=lambda j=job: (scheduler.resume(j.id), update_job_list())).props('flat dense')
+                if not job.is_finished:
+                    ui.button(state.t('cancel'), on_click=lambda j=job: (scheduler.cancel(j.id), update_job_list())).props('flat dense color=negative')
+
+
+# ============ 文件夹输入 ============
+
+FOLDER_CHUNK_SIZE = 500  # 遍历文件夹时每次加入任务的图片数
+
+
+def iter_image_tree(root: str, extensions: Tuple[str, ...] = IMAGE_EXTENSIONS + VIDEO_EXTENSIONS + ARCHIVE_EXTENSIONS,
+                    workers: int = SCAN_WORKERS):
+    """并行遍历目录树，边发现边产出文件路径
+    
+    每个目录由线程池中的一个任务用 os.scandir 读取，只按文件名过滤扩展名，
+    目录判断使用 scandir 自带的类型信息，不对每个文件 stat。
+    同一目录内的文件按名称排序，不同目录之间按完成顺序产出。
+    """
+    def scan(directory: str) -> Tuple[List[str], List[str]]:
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(extensions):
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"读取文件夹失败: {e}")
+        return sorted(files), sorted(subdirs)
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wd14-scan') as pool:
+        pending = {pool.submit(scan, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(pool.submit(scan, subdir) for subdir in subdirs)
+                yield from files
+
+
+def common_input_root(paths: Iterable[str]) -> Optional[str]:
+    """多张图片的公共上级目录，用作 mirror 输出方式的根目录"""
+    dirs = {os.path.dirname(os.path.abspath(path)) for path in paths}
+    try:
+        return os.path.commonpath(list(dirs)) if dirs else None
+    except ValueError:  # Windows 下不同盘符
+        return None
+
+
+async def tag_folder(folder: str):
+    """把整个文件夹（包括子文件夹）加入图片列表并打标，遍历与打标同时进行"""
+    folder = os.path.abspath(folder)
+    options = current_tagging_options(input_root=folder)
+    job = TaggingJob([], options, priority=int(priority_input.value or 0))
+    job.discovering = True
+    scheduler.submit(job)
+    update_job_list()
+    ui.notify(state.t('folder_scanning', folder=folder), type='info')
+    
+    loop = asyncio.get_running_loop()
+    
+    rejected: List[Tuple[str, str]] = []
+    
+    def add_chunk(chunk: List[str]):
+        state.catalog.add(chunk)
+        job.image_paths.extend(chunk)
+    
+    def flush(chunk: List[str]) -> int:
+        # 先探测文件头，损坏的文件不进入任务
+        valid, bad = filter_valid_images(chunk)
+        rejected.extend(bad)
+        loop.call_soon_threadsafe(add_chunk, valid)
+        return len(valid)
+    
+    def enumerate_folder() -> int:
+        count, chunk = 0, []
+        for path in iter_image_tree(folder):
+            chunk.append(path)
+            if len(chunk) >= FOLDER_CHUNK_SIZE:
+                count += flush(chunk)
+                chunk = []
+        if chunk:
+            count += flush(chunk)
+        return count
+    
+    try:
+        count = await run.io_bound(enumerate_folder)
+    finally:
+        await asyncio.sleep(0)  # 等最后一批加入后再结束遍历状态
+        job.discovering = False
+    update_gallery()
+    update_job_list()
+    ui.notify(state.t('folder_scanned', count=count, folder=folder), type='positive')
+    notify_rejected(rejected)
+
+
+# ============ 监视文件夹 ============
+
+WATCH_POLL_INTERVAL = 2.0  # 轮询间隔（秒）
+WATCH_DEBOUNCE = 3.0  # 文件大小和修改时间保持不变超过该时长才视为写入完成
+WATCH_FULL_CHECK_INTERVAL = 1800.0  # 轮询模式下每隔多少秒检查一次所有目录（捕获原地改写、目录修改时间不变的情况）
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # 未安装 watchdog 时只使用轮询
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class _DirtyDirHandler(FileSystemEventHandler):
+    """文件系统事件只用来标记需要重新扫描的目录，去抖和入队逻辑与轮询共用"""
+    def __init__(self, watcher: 'FolderWatcher'):
+        self.watcher = watcher
+    
+    def on_any_event(self, event):
+        for path in (getattr(event, 'src_path', None), getattr(event, 'dest_path', None)):
+            if path:
+                self.watcher.mark_dirty(path if event.is_directory else os.path.dirname(path))
+
+
+class FolderWatcher:
+    """监视一个或多个输入目录，把新增或改动的图片按批加入任务队列
+    
+    安装了 watchdog 时使用系统文件事件（inotify 等），否则按目录修改时间增量轮询：
+    只对修改时间变化的目录重新 os.scandir（原地改写不会改变目录修改时间，轮询模式下
+    每 WATCH_FULL_CHECK_INTERVAL 秒补查一次所有目录）。文件在大小和修改时间
+    稳定 WATCH_DEBOUNCE 秒后才入队，避免处理还在写入的文件。
+    新文件追加到同一个未结束的监视任务中，任务结束后再有文件才创建新任务，并移除上一个已结束的任务。
+    """
+    def __init__(self, directories: List[str], options_factory, priority: int = 0):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.options_factory = options_factory  # 每批入队时生成 TaggingOptions（可传入 overwrite）
+        self.priority = priority
+        self.running = False
+        self.queued_count = 0
+        self._dirs: Dict[str, int] = {}  # 目录 -> 上次扫描时的修改时间
+        self._files: Dict[str, Tuple[int, int]] = {}  # 已入队文件 -> (大小, 修改时间)
+        self._pending: Dict[str, Tuple[int, int, float]] = {}  # 候选文件 -> (大小, 修改时间, 稳定起始时间)
+        self._dirty: set = set()
+        self._dirty_lock = threading.Lock()
+        self._last_full_check = 0.0
+        self._jobs: Dict[bool, TaggingJob] = {}  # 是否重新打标 -> 最近一个监视任务
+        self._observer = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def mark_dirty(self, directory: str):
+        with self._dirty_lock:
+            self._dirty.add(directory)
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+    
+    def _scan_dir(self, directory: str, now: float):
+        """重新扫描单个目录（不递归），新子目录在下次轮询时扫描"""
+        try:
+            self._dirs[directory] = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            self._dirs.pop(directory, None)
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self._dirs:
+                    self._dirs[entry.path] = -1  # 新目录：下次轮询时扫描
+                continue
+            if not entry.name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS + ARCHIVE_EXTENSIONS):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            if self._files.get(entry.path) != signature and entry.path not in self._pending:
+                self._pending[entry.path] = (*signature, now)
+    
+    def snapshot(self):
+        """记录当前已有的文件，启动监视前已存在的图片不会入队"""
+        now = time.monotonic()
+        self._dirs = {d: -1 for d in self.directories}
+        while any(mtime == -1 for mtime in self._dirs.values()):
+            for directory in [d for d, mtime in self._dirs.items() if mtime == -1]:
+                self._scan_dir(directory, now)
+        for path, (size, mtime, _) in self._pending.items():
+            self._files[path] = (size, mtime)
+        self._pending.clear()
+        self._last_full_check = now
+    
+    def poll(self) -> Tuple[List[str], List[str]]:
+        """执行一次增量检查，返回写入完成的 (新文件, 改动过的文件)"""
+        now = time.monotonic()
+        # 文件事件模式下原地改写也会产生事件，不需要全量检查
+        full_check = self._observer is None and now - self._last_full_check >= WATCH_FULL_CHECK_INTERVAL
+        if full_check:
+            self._last_full_check = now
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        
+        for directory in list(self._dirs):
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._dirs.pop(directory, None)
+                continue
+            if full_check or directory in dirty or mtime != self._dirs[directory]:
+                self._scan_dir(directory, now)
+        
+        # 只对候选文件单独 stat，等待写入完成
+        new_files, changed_files = [], []
+        for path, (size, mtime, stable_since) in list(self._pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self._pending[path] = (st.st_size, st.st_mtime_ns, now)
+            elif now - stable_since >= WATCH_DEBOUNCE and st.st_size > 0:
+                del self._pending[path]
+                (changed_files if path in self._files else new_files).append(path)
+                self._files[path] = (size, mtime)
+        return new_files, changed_files
+    
+    async def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await run.io_bound(self.snapshot)
+        if Observer is not None:
+            self._observer = Observer()
+            handler = _DirtyDirHandler(self)
+            for directory in self.directories:
+                self._observer.schedule(handler, directory, recursive=True)
+            self._observer.start()
+        # 预先加载模型，新文件到达时无需等待加载
+        options = self.options_factory(False)
+        if inference_client is None:
+            models = [options.model] if isinstance(options.model, str) else options.model
+            for model in models:
+                await run.io_bound(get_cached_model, model)
+        self._task = background_tasks.create(self._run(), name='wd14-folder-watcher')
+    
+    def stop(self):
+        self.running = False
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._wakeup:
+            self._wakeup.set()
+    
+    def _enqueue(self, paths: List[str], overwrite: bool):
+        job = self._jobs.get(overwrite)
+        if job is not None and not job.is_finished:
+            # 排队、运行或暂停中的任务直接追加，调度器按 job.total 继续处理
+            job.image_paths.extend(paths)
+            return
+        if job is not None:
+            scheduler.jobs.pop(job.id, None)
+        self._jobs[overwrite] = scheduler.submit(TaggingJob(paths, self.options_factory(overwrite), self.priority))
+    
+    async def _run(self):
+        while self.running:
+            new_files, changed_files = await run.io_bound(self.poll)
+            for paths, overwrite in ((new_files, False), (changed_files, True)):
+                if paths:
+                    self.queued_count += len(paths)
+                    self._enqueue(sorted(paths), overwrite)
+                    update_job_list()
+            try:
+                # 有文件在等待写入完成时按去抖间隔检查，否则按轮询间隔或文件事件唤醒
+                timeout = min(WATCH_POLL_INTERVAL, WATCH_DEBOUNCE / 2) if self._pending else WATCH_POLL_INTERVAL
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+folder_watcher: Optional[FolderWatcher] = None
+
+
+def current_tagging_options(overwrite: bool = False, input_root: Optional[str] = None) -> TaggingOptions:
+    """按界面当前设置生成处理参数，input_root 为 mirror 输出方式的输入根目录"""
+    model = model_select.value
+    # 集成模式：选择了两个及以上模型时同时使用这些模型
+    ensemble = get_ensemble_settings()
+    if len(ensemble_select.value or []) >= 2:
+        model = list(ensemble_select.value)
+    return TaggingOptions(model, threshold_slider.value, output_input.value or DEFAULT_OUTPUT_DIR,
+                          lang=state.current_lang, ensemble_mode=ensemble.get('mode', 'mean'),
+                          ensemble_weights=ensemble.get('weights') or None,
+                          profile=get_output_profile(profile_select.value),
+                          retag_mode='overwrite' if overwrite else get_retag_mode(),
+                          output_mode=get_output_mode(), input_root=input_root,
+                          **tuned_batch_settings(model if isinstance(model, str) else model[0]))
+
+
+def tuned_batch_settings(model_name: str) -> dict:
+    """本机调优得到的批大小和预处理线程数，未调优时使用默认值"""
+    tuning = get_tuning(model_name) or {}
+    return {'batch_size': tuning.get('batch_size'), 'workers': tuning.get('workers')}
+
+
+async def toggle_folder_watch():
+    """开始/停止监视文件夹"""
+    global folder_watcher
+    if folder_watcher and folder_watcher.running:
+        folder_watcher.stop()
+        folder_watcher = None
+        ui.notify(state.t('watch_stopped'), type='info')
+    else:
+        directories = [d.strip() for d in (watch_input.value or '').replace(';', '\n').splitlines() if d.strip()]
+        missing = [d for d in directories if not os.path.isdir(d)]
+        if not directories or missing:
+            ui.notify(state.t('watch_invalid_dirs', dirs=', '.join(missing)), type='warning')
+            return
+        set_watch_dirs(directories)
+        # 设置在开始监视时确定，之后的改动不影响正在监视的任务
+        snapshot = current_tagging_options(input_root=os.path.commonpath([os.path.abspath(d) for d in directories]))
+        # 已打标文件被修改时重新打标；diff 模式下仍只改写标签有变化的文件
+        factory = lambda overwrite: TaggingOptions.from_dict(
+            {**snapshot.to_dict(), 'retag_mode': 'overwrite' if overwrite and snapshot.retag_mode == 'skip'
+             else snapshot.retag_mode})
+        folder_watcher = FolderWatcher(directories, factory, priority=int(priority_input.value or 0))
+        await folder_watcher.start()
+        mode = 'watchdog' if Observer is not None else state.t('watch_polling')
+        ui.notify(state.t('watch_started', count=len(directories), mode=mode), type='positive')
+    update_watch_status()
+
+
+def update_watch_status():
+    """刷新监视按钮和状态"""
+    if 'watch_button' not in state.ui_refs:
+        return
+    watching = folder_watcher is not None and folder_watcher.running
+    state.ui_refs['watch_button'].set_text(state.t('stop_watch' if watching else 'start_watch'))
+    state.ui_refs['watch_status'].set_text(
+        state.t('watch_status', count=folder_watcher.queued_count) if watching else '')
+
+
+async def start_processing():
+    """开始处理图片 - 创建打标任务并加入任务队列"""
+    if not len(state.catalog):
+        ui.notify(state.t('please_upload_images_first'), type='warning')
+        return
+    
+    if not state.catalog.count(status='pending'):
+        # 全部处理过时重新处理全部图片
+        state.catalog.reset_statuses()
+    input_root = common_input_root(state.catalog.iter_paths('pending')) if get_output_mode() == 'mirror' else None
+    options = current_tagging_options(input_root=input_root)
+    print(f"[DEBUG] Output directory: {options.output_dir}")
+    job = TaggingJob([], options, priority=int(priority_input.value or 0), catalog=state.catalog)
+    if scheduler.current is None:
+        status_output.value = ''
+        # 初始化左侧进度信息框
+        progress_info.set_value(state.t('processing_started'))
+        ui.notify(state.t('processing_started'), type='positive')
+    else:
+        ui.notify(state.t('job_queued', id=job.id), type='info')
+    scheduler.submit(job)
+    update_job_list()
+
+
+# ============ HTTP API ============
+
+class InferenceRequest:
+    """等待推理的单个请求"""
+    def __init__(self, image_array: np.ndarray, model_name: str, threshold: float, profile: Optional[dict] = None):
+        self.image_array = image_array
+        self.model_name = model_name
+        self.threshold = threshold
+        self.profile = profile
+        self.future: Future = Future()
+
+
+class InferenceBatcher:
+    """共享推理工作线程：把并发请求按模型合并成批次推理
+    
+    凑满 max_batch_size 或等待超过 max_wait_ms 即执行一批；
+    等待队列有上限，超出时 submit 抛出 queue.Full，由调用方返回 429。
+    """
+    def __init__(self, max_batch_size: int = API_MAX_BATCH_SIZE, max_wait_ms: int = API_MAX_WAIT_MS,
+                 max_queue: int = API_MAX_QUEUE):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._deferred: deque = deque()  # 取出但属于其他模型的请求，下一批优先处理
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+    
+    def submit(self, image_array: np.ndarray, model_name: str, threshold: float,
+               profile: Optional[dict] = None) -> Future:
+        """提交一张预处理后的图片，返回 Future，结果为 (标签, 分数) 列表"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='wd14-batcher', daemon=True)
+                self._thread.start()
+        request = InferenceRequest(image_array, model_name, threshold, profile)
+        self.queue.put_nowait(request)
+        return request.future
+    
+    def _next_request(self, timeout: Optional[float] = None) -> InferenceRequest:
+        if self._deferred:
+            return self._deferred.popleft()
+        return self.queue.get(timeout=timeout)
+    
+    def _collect_batch(self) -> List[InferenceRequest]:
+        first = self._next_request()
+        batch = [first]
+        # 先合并之前被推迟的同模型请求
+        for request in list(self._deferred):
+            if len(batch) >= self.max_batch_size:
+                break
+            if request.model_name == first.model_name:
+                self._deferred.remove(request)
+                batch.append(request)
+        
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request.model_name == first.model_name:
+                batch.append(request)
+            else:
+                self._deferred.append(request)
+        # 跳过调用方已取消的请求
+        return [r for r in batch if r.future.set_running_or_notify_cancel()]
+    
+    def _loop(self):
+        while True:
+            batch = self._collect_batch()
+            if batch:
+                self._run_batch(batch)
+    
+    def _run_batch(self, batch: List[InferenceRequest]):
+        model_name = batch[0].model_name
+        try:
+            images = np.concatenate([r.image_array for r in batch], axis=0)
+            infer = inference_client.infer if inference_client else infer_tag_scores
+            general_output, character_output, tag_data = infer(model_name, images)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        
+        for i, request in enumerate(batch):
+            try:
+                tags = scores_to_tags(general_output[i],
+                                      character_output[i] if character_output is not None else None,
+                                      tag_data, request.threshold, compile_tag_rules(request.profile, tag_data))
+                request.future.set_result(tags)
+            except Exception as e:
+                request.future.set_exception(e)
+
+
+api_batcher = InferenceBatcher()
+
+
+class TagPathRequest(BaseModel):
+    path: str
+    model: Optional[str] = None
+    threshold: Optional[float] = None
+    profile: Optional[str] = None
+
+
+class TagPathsRequest(BaseModel):
+    paths: List[str]
+    model: Optional[str] = None
+    threshold: Optional[float] = None
+    profile: Optional[str] = None
+
+
+def _format_api_result(image: str, model: str, threshold: float, tags: List[Tuple[str, float]]) -> dict:
+    return {
+        'image': image,
+        'model': model,
+        'threshold': threshold,
+        'tags': ", ".join(tag for tag, _ in tags),
+        'scores': {tag: round(score, 4) for tag, score in tags},
+    }
+
+
+def _resolve_api_options(model: Optional[str], threshold: Optional[float]) -> Tuple[str, float]:
+    """未指定模型/阈值时使用界面当前的设置"""
+    return model or get_last_model(), get_threshold() if threshold is None else threshold
+
+
+def _submit_to_batcher(image_array: np.ndarray, model: str, threshold: float, profile: Optional[str] = None) -> Future:
+    try:
+        return api_batcher.submit(image_array, model, threshold, get_output_profile(profile))
+    except queue.Full:
+        raise HTTPException(status_code=429, detail="推理队列已满，请稍后重试")
+
+
+async def _await_tags(future: Future) -> List[Tuple[str, float]]:
+    try:
+        return await asyncio.wrap_future(future)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post('/api/tag')
+async def api_tag_upload(file: UploadFile = File(...), model: Optional[str] = Form(None),
+                         threshold: Optional[float] = Form(None), profile: Optional[str] = Form(None)):
+    """上传单张图片打标"""
+    model, threshold = _resolve_api_options(model, threshold)
+    data = await file.read()
+    image_array, _ = await run.io_bound(preprocess_image_guarded, io.BytesIO(data), (448, 448), API_UPLOAD_MAX_PIXELS)
+    if image_array is None:
+        raise HTTPException(status_code=400, detail=f"图片预处理失败: {file.filename}")
+    tags = await _await_tags(_submit_to_batcher(image_array, model, threshold, profile))
+    return _format_api_result(file.filename, model, threshold, tags)
+
+
+@app.post('/api/tag/path')
+async def api_tag_path(request: TagPathRequest):
+    """按服务器端路径为单张图片打标"""
+    model, threshold = _resolve_api_options(request.model, request.threshold)
+    if not os.path.isfile(request.path):
+        raise HTTPException(status_code=404, detail=f"文件不存在: {request.path}")
+    image_array, _ = await run.io_bound(preprocess_image_guarded, request.path)
+    if image_array is None:
+        raise HTTPException(status_code=400, detail=f"图片预处理失败: {request.path}")
+    tags = await _await_tags(_submit_to_batcher(image_array, model, threshold, request.profile))
+    return _format_api_result(request.path, model, threshold, tags)
+
+
+@app.post('/api/tag/paths')
+async def api_tag_paths(request: TagPathsRequest):
+    """按服务器端路径批量打标，单张失败不影响其他图片"""
+    model, threshold = _resolve_api_options(request.model, request.threshold)
+    
+    async def _preprocess(path: str) -> Optional[np.ndarray]:
+        if not os.path.isfile(path):
+            return None
+        image_array, _ = await run.io_bound(preprocess_image_guarded, path)
+        return image_array
+    
+    results = []
+    # 按批大小分段处理：段内并发预处理以便合并为同一批次，等本段结果返回后再处理下一段，
+    # 任意长度的列表都不会一次占满等待队列，预处理结果也只保留一段
+    for start in range(0, len(request.paths), api_batcher.max_batch_size):
+        chunk = request.paths[start:start + api_batcher.max_batch_size]
+        arrays = await asyncio.gather(*(_preprocess(path) for path in chunk))
+        
+        futures: List[Optional[Future]] = []
+        try:
+            for image_array in arrays:
+                futures.append(None if image_array is None else
+                               _submit_to_batcher(image_array, model, threshold, request.profile))
+        except HTTPException:
+            # 队列已满（其他请求占满）：撤销本段已提交的请求，整体返回 429
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+            raise
+        
+        for path, future in zip(chunk, futures):
+            if future is None:
+                error = f"文件不存在: {path}" if not os.path.isfile(path) else f"图片预处理失败: {path}"
+                results.append({'image': path, 'error': error})
+                continue
+            try:
+                tags = await asyncio.wrap_future(future)
+                results.append(_format_api_result(path, model, threshold, tags))
+            except Exception as e:
+                results.append({'image': path, 'error': str(e)})
+    return {'results': results}
+
+
+# ============ 独立推理进程 ============
+
+INFERENCE_SERVER_PORT = 7961  # 独立推理进程默认端口
+
+
+def serve_inference(port: int, authkey: bytes):
+    """独立推理进程主循环：持有模型会话，通过本地 socket 为一个或多个界面进程服务
+    
+    协议：每条请求先发送 JSON 头，infer 请求随后发送 uint8 的 448×448 图像字节（在本进程中转为 float32）；
+    响应同样是 JSON 头，infer 响应随后发送 general/character 分数的原始 float32 字节。
+    """
+    listener = Listener(('127.0.0.1', port), authkey=authkey)
+    print(f'推理进程已启动: 127.0.0.1:{port}')
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            print(f'推理进程连接失败: {e}')
+            continue
+        threading.Thread(target=_serve_inference_connection, args=(conn,), daemon=True).start()
+
+
+def _serve_inference_connection(conn):
+    with conn:
+        while True:
+            try:
+                header = json.loads(conn.recv_bytes())
+            except (EOFError, OSError):
+                return
+            op = header.get('op')
+            try:
+                if op == 'ping':
+                    conn.send_bytes(json.dumps({'ok': True, 'pid': os.getpid()}).encode())
+                elif op == 'infer':
+                    payload = conn.recv_bytes()
+                    batch = np.frombuffer(payload, dtype=header['dtype']).reshape(header['shape'])
+                    general_output, character_output, _ = infer_tag_scores(
+                        header['model'], batch.astype(np.float32, copy=False),
+                        header.get('ensemble_mode', 'mean'), header.get('ensemble_weights'))
+                    general_output = np.ascontiguousarray(general_output, dtype=np.float32)
+                    reply = {'ok': True, 'general_shape': general_output.shape,
+                             'character_shape': character_output.shape if character_output is not None else None}
+                    conn.send_bytes(json.dumps(reply).encode())
+                    conn.send_bytes(general_output)
+                    if character_output is not None:
+                        conn.send_bytes(np.ascontiguousarray(character_output, dtype=np.float32))
+                elif op == 'process':
+                    stats: dict = {}
+                    results = process_image_batch(header['paths'], TaggingOptions.from_dict(header['options']), stats)
+                    conn.send_bytes(json.dumps({'ok': True, 'results': results, 'stats': stats},
+                                               ensure_ascii=False).encode())
+                else:
+                    conn.send_bytes(json.dumps({'ok': False, 'error': f'未知操作: {op}'}).encode())
+            except Exception as e:
+                print(f'推理进程处理请求失败: {e}')
+                conn.send_bytes(json.dumps({'ok': False, 'error': str(e)}, ensure_ascii=False).encode())
+
+
+class InferenceServerClient:
+    """连接独立推理进程的客户端，每个线程使用独立的连接"""
+    def __init__(self, port: int, authkey: bytes):
+        self.port = port
+        self.authkey = authkey
+        self._local = threading.local()
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = Client(('127.0.0.1', self.port), authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+    
+    def _request(self, header: dict, payload: Optional[np.ndarray] = None):
+        """发送请求并读取响应头；连接断开时重连一次"""
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.send_bytes(json.dumps(header, ensure_ascii=False).encode())
+                if payload is not None:
+                    conn.send_bytes(memoryview(payload).cast('B'))  # 按字节发送（多维 uint8 数组直接发送只会取第一维长度）
+                reply = json.loads(conn.recv_bytes())
+                break
+            except (EOFError, OSError):
+                self._local.conn = None
+                if attempt:
+                    raise
+        if not reply.get('ok'):
+            raise RuntimeError(reply.get('error', '推理进程返回错误'))
+        return reply, conn
+    
+    def ping(self) -> bool:
+        try:
+            self._request({'op': 'ping'})
+            return True
+        except Exception:
+            return False
+    
+    def infer(self, model: Union[str, List[str]], batch: np.ndarray, ensemble_mode: str = 'mean',
+              ensemble_weights: Optional[List[float]] = None
+              ) -> Tuple[np.ndarray, Optional[np.ndarray], Tuple[List[str], List[str]]]:
+        """与 infer_tag_scores 相同，但推理在独立进程中执行
+        
+        预处理结果是 0~255 的像素值，按 uint8 发送（体积为 float32 的 1/4），
+        缩放插值产生的小数部分四舍五入，分数偏差可用精度对比工具检查
+        """
+        if batch.dtype != np.uint8:
+            batch = np.clip(np.rint(batch), 0, 255).astype(np.uint8)
+        batch = np.ascontiguousarray(batch)
+        header = {'op': 'infer', 'model': model, 'shape': batch.shape, 'dtype': batch.dtype.str,
+                  'ensemble_mode': ensemble_mode, 'ensemble_weights': ensemble_weights}
+        reply, conn = self._request(header, batch)
+        general_output = np.frombuffer(conn.recv_bytes(), dtype=np.float32).reshape(reply['general_shape'])
+        character_output = None
+        if reply['character_shape'] is not None:
+            character_output = np.frombuffer(conn.recv_bytes(), dtype=np.float32).reshape(reply['character_shape'])
+        first_model = model if isinstance(model, str) else model[0]
+        return general_output, character_output, get_cached_tag_data(first_model)
+    
+    def process_image_batch(self, image_paths: List[str], options: TaggingOptions,
+                            stats: Optional[dict] = None) -> List[Tuple[str, str, str]]:
+        """与 process_image_batch 相同，解码、预处理和推理都在独立进程中执行"""
+        header = {'op': 'process', 'paths': image_paths, 'options': options.to_dict()}
+        reply, _ = self._request(header)
+        if stats is not None:
+            merge_process_stats(stats, reply.get('stats', {}))
+        return [tuple(result) for result in reply['results']]
+
+
+inference_client: Optional[InferenceServerClient] = None
+_inference_server_process: Optional[subprocess.Popen] = None
+
+
+def start_inference_server() -> bool:
+    """启用独立推理进程：已有进程在监听时直接复用，否则启动新进程"""
+    global inference_client, _inference_server_process
+    settings = get_inference_server_settings()
+    client = InferenceServerClient(settings['port'], settings['authkey'].encode())
+    if not client.ping():
+        env = dict(os.environ, WD14_INFERENCE_AUTHKEY=settings['authkey'])
+        _inference_server_process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--inference-server', '--port', str(settings['port'])], env=env)
+        deadline = time.monotonic() + 30
+        while not client.ping():
+            if time.monotonic() > deadline or _inference_server_process.poll() is not None:
+                print('❌ 推理进程启动失败')
+                return False
+            time.sleep(0.5)
+    inference_client = client
+    return True
+
+
+def stop_inference_server():
+    """停用独立推理进程，由本进程启动的推理进程会被关闭"""
+    global inference_client, _inference_server_process
+    inference_client = None
+    if _inference_server_process is not None:
+        _inference_server_process.terminate()
+        _inference_server_process = None
+
+
+async def toggle_inference_server(enabled: bool):
+    """界面开关：切换推理模式并保存设置"""
+    settings = get_inference_server_settings()
+    settings['enabled'] = enabled
+    set_inference_server_settings(settings)
+    if enabled:
+        if await run.io_bound(start_inference_server):
+            ui.notify(state.t('inference_server_started'), type='positive')
+        else:
+            ui.notify(state.t('inference_server_failed'), type='negative')
+    else:
+        stop_inference_server()
+
+
+# ============ 分布式打标 ============
+
+COORDINATOR_PORT = 7962  # 协调器默认端口
+LEASE_SIZE = 64  # 每次租约分配的图片数
+LEASE_TIMEOUT = 300  # 租约超时时间（秒），超时未续约的图片重新分配
+
+
+def iter_image_files(root: str):
+    """遍历目录树，按目录顺序逐个产出图片路径"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(dirpath, filename)
+
+
+class Lease:
+    """分配给某个 worker 的一批图片"""
+    def __init__(self, lease_id: str, worker_id: str, paths: List[str], timeout: float):
+        self.id = lease_id
+        self.worker_id = worker_id
+        self.paths = paths
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+    
+    def renew(self):
+        self.expires_at = time.monotonic() + self.timeout
+
+
+class DistributedCoordinator:
+    """协调器：遍历输入目录，把图片按租约分发给任意数量的 worker，并汇总结果写入输出目录
+    
+    worker 通过 HTTP 领取租约、续约和提交结果；租约超时（worker 崩溃或失联）后
+    其中的图片会重新分配给其他 worker。已有 txt 的图片在分配前跳过，便于中断后续跑。
+    txt 在输出目录中保留相对输入目录的文件夹结构（mirror 输出方式），不同子文件夹中的同名图片互不覆盖。
+    """
+    def __init__(self, input_dir: str, output_dir: str, model: Union[str, List[str]], threshold: float,
+                 lease_size: int = LEASE_SIZE, lease_timeout: float = LEASE_TIMEOUT, profile: Optional[dict] = None):
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = output_dir
+        self.model = model
+        self.threshold = threshold
+        self.profile = profile  # 输出规则，随租约下发给 worker
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self._source = iter_image_files(self.input_dir)
+        self._source_exhausted = False
+        self._retry: deque = deque()  # 超时租约退回的图片，优先重新分配
+        self.leases: Dict[str, Lease] = {}
+        self.workers: Dict[str, float] = {}  # worker_id -> 最近一次请求时间
+        self.counts = {'completed': 0, 'skipped': 0, 'failed': 0, 'reassigned': 0}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+    
+    def txt_path(self, image_path: str) -> str:
+        return get_txt_path(image_path, self.output_dir, output_mode='mirror', input_root=self.input_dir)
+    
+    @property
+    def is_done(self) -> bool:
+        with self._lock:
+            return self._source_exhausted and not self._retry and not self.leases
+    
+    def _reap_expired(self):
+        now = time.monotonic()
+        for lease in [l for l in self.leases.values() if l.expires_at < now]:
+            print(f'租约超时，重新分配 {len(lease.paths)} 张图片: {lease.id} ({lease.worker_id})')
+            del self.leases[lease.id]
+            self._retry.extend(lease.paths)
+            self.counts['reassigned'] += len(lease.paths)
+    
+    def _take_paths(self) -> List[str]:
+        paths = []
+        while self._retry and len(paths) < self.lease_size:
+            paths.append(self._retry.popleft())
+        while not self._source_exhausted and len(paths) < self.lease_size:
+            path = next(self._source, None)
+            if path is None:
+                self._source_exhausted = True
+                break
+            if os.path.exists(self.txt_path(path)):
+                self.counts['skipped'] += 1
+                continue
+            paths.append(os.path.relpath(path, self.input_dir))
+        return paths
+    
+    def lease(self, worker_id: str) -> dict:
+        """为 worker 分配一批图片；全部完成时返回 done"""
+        with self._lock:
+            self.workers[worker_id] = time.time()
+            self._reap_expired()
+            paths = self._take_paths()
+            if not paths:
+                done = self._source_exhausted and not self._retry and not self.leases
+                # 其他 worker 的租约尚未完成，稍后再来（它们可能超时后被重新分配）
+                return {'done': done, 'paths': [], 'retry_after': 5}
+            lease = Lease(secrets.token_hex(8), worker_id, paths, self.lease_timeout)
+            self.leases[lease.id] = lease
+            return {'done': False, 'lease_id': lease.id, 'paths': paths, 'input_dir': self.input_dir,
+                    'model': self.model, 'threshold': self.threshold, 'profile': self.profile,
+                    'lease_timeout': self.lease_timeout}
+    
+    def heartbeat(self, lease_id: str) -> bool:
+        with self._lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return False
+            lease.renew()
+            self.workers[lease.worker_id] = time.time()
+            return True
+    
+    def complete(self, lease_id: str, results: Dict[str, str], errors: Dict[str, str]) -> bool:
+        """提交租约结果并写入 txt；租约已超时被重新分配时拒绝，避免重复写入"""
+        with self._lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            self.workers[lease.worker_id] = time.time()
+        
+        for rel_path in lease.paths:
+            image_path = os.path.join(self.input_dir, rel_path)
+            tags = results.get(rel_path)
+            if tags is None:
+                success, msg = False, errors.get(rel_path, '未返回结果')
+            else:
+                success, msg = save_tags_to_txt(image_path, tags, "", self.output_dir,
+                                                output_mode='mirror', input_root=self.input_dir)
+            with self._lock:
+                self.counts['completed' if success else 'failed'] += 1
+            if not success:
+                print(f'❌ {rel_path}: {msg}')
+        return True
+    
+    def status(self) -> dict:
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            return {
+                'input_dir': self.input_dir,
+                'output_dir': self.output_dir,
+                'counts': dict(self.counts),
+                'active_leases': len(self.leases),
+                'pending_retry': len(self._retry),
+                'enumeration_done': self._source_exhausted,
+                'workers': {w: round(time.time() - t, 1) for w, t in self.workers.items()},
+                'images_per_sec': round(self.counts['completed'] / elapsed, 2) if elapsed > 0 else 0.0,
+            }
+
+
+class _CoordinatorHandler(BaseHTTPRequestHandler):
+    """协调器的 HTTP 接口（JSON）"""
+    coordinator: DistributedCoordinator = None
+    
+    def _reply(self, code: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.coordinator.status())
+        else:
+            self._reply(404, {'error': 'not found'})
+    
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            self._reply(400, {'error': 'invalid json'})
+            return
+        if self.path == '/lease':
+            self._reply(200, self.coordinator.lease(body.get('worker_id', self.client_address[0])))
+        elif self.path == '/heartbeat':
+            ok = self.coordinator.heartbeat(body.get('lease_id', ''))
+            self._reply(200 if ok else 409, {'ok': ok})
+        elif self.path == '/complete':
+            ok = self.coordinator.complete(body.get('lease_id', ''), body.get('results', {}), body.get('errors', {}))
+            self._reply(200 if ok else 409, {'ok': ok})
+        else:
+            self._reply(404, {'error': 'not found'})
+    
+    def log_message(self, format, *args):
+        pass  # 不打印每个请求
+
+
+def run_coordinator(input_dir: str, output_dir: str, model: Union[str, List[str]], threshold: float,
+                    host: str = '0.0.0.0', port: int = COORDINATOR_PORT, lease_size: int = LEASE_SIZE,
+                    lease_timeout: float = LEASE_TIMEOUT, profile: Optional[dict] = None) -> dict:
+    """启动协调器并阻塞到所有图片处理完成，返回最终统计"""
+    coordinator = DistributedCoordinator(input_dir, output_dir, model, threshold, lease_size, lease_timeout, profile)
+    handler = type('CoordinatorHandler', (_CoordinatorHandler,), {'coordinator': coordinator})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'协调器已启动: http://{host}:{port}  输入: {coordinator.input_dir}  输出: {output_dir}')
+    
+    try:
+        while not coordinator.is_done:
+            time.sleep(2)
+            with coordinator._lock:
+                coordinator._reap_expired()
+        # 留出时间让 worker 收到 done
+        time.sleep(3)
+    finally:
+        server.shutdown()
+    status = coordinator.status()
+    print(f"协调器完成: {status['counts']}")
+    return status
+
+
+def _post_json(url: str, body: dict, timeout: float = 60) -> Tuple[int, dict]:
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def tag_lease_paths(paths: List[str], input_dir: str, model: Union[str, List[str]], threshold: float,
+                    batch_size: int = JOB_BATCH_SIZE, on_batch=None,
+                    profile: Optional[dict] = None) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """worker 端：预处理并批量推理租约中的图片，返回 (标签结果, 错误信息)，键为相对路径"""
+    results, errors = {}, {}
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        arrays = []
+        for rel_path in chunk:
+            image_array, _ = preprocess_image_guarded(os.path.join(input_dir, rel_path))
+            if image_array is None:
+                errors[rel_path] = "Error: 图片预处理失败"
+            else:
+                arrays.append((rel_path, image_array))
+        if arrays:
+            try:
+                general_output, character_output, tag_data = infer_tag_scores(
+                    model, np.concatenate([a for _, a in arrays], axis=0))
+                rules = compile_tag_rules(profile, tag_data)
+                for row, (rel_path, _) in enumerate(arrays):
+                    tags = scores_to_tags(general_output[row],
+                                          character_output[row] if character_output is not None else None,
+                                          tag_data, threshold, rules)
+                    results[rel_path] = ", ".join(tag for tag, _ in tags)
+            except Exception as e:
+                for rel_path, _ in arrays:
+                    errors[rel_path] = f"Error: {str(e)}"
+        if on_batch:
+            on_batch()
+    return results, errors
+
+
+def run_worker(coordinator_url: str, worker_id: Optional[str] = None, input_root: Optional[str] = None,
+               batch_size: int = JOB_BATCH_SIZE):
+    """worker 主循环：领取租约 → 打标 → 提交结果，直到协调器返回 done
+    input_root 用于本机挂载路径与协调器不同的情况
+    """
+    import socket
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    coordinator_url = coordinator_url.rstrip('/')
+    print(f'worker {worker_id} 已连接协调器: {coordinator_url}')
+    processed = 0
+    while True:
+        try:
+            _, lease = _post_json(f'{coordinator_url}/lease', {'worker_id': worker_id})
+        except (urllib.error.URLError, OSError) as e:
+            print(f'无法连接协调器: {e}')
+            return processed
+        if lease.get('done'):
+            print(f'worker {worker_id} 完成，共处理 {processed} 张图片')
+            return processed
+        if not lease.get('paths'):
+            time.sleep(lease.get('retry_after', 5))
+            continue
+        
+        lease_id = lease['lease_id']
+        heartbeat = lambda: _post_json(f'{coordinator_url}/heartbeat', {'lease_id': lease_id})
+        results, errors = tag_lease_paths(lease['paths'], input_root or lease['input_dir'], lease['model'],
+                                          lease['threshold'], batch_size, on_batch=heartbeat,
+                                          profile=lease.get('profile'))
+        code, _ = _post_json(f'{coordinator_url}/complete',
+                             {'lease_id': lease_id, 'worker_id': worker_id, 'results': results, 'errors': errors})
+        if code == 409:
+            print(f'租约已超时并被重新分配，丢弃结果: {lease_id}')
+        else:
+            processed += len(lease['paths'])
+
+
+# ============ 主程序 ============
+
+@ui.page('/')
+def main_page():
+    """主页面"""
+    # 添加 Tailwind CSS
+    ui.add_head_html('''
+        <script src="https://cdn.tailwindcss.com"></script>
+        <style>
+            .gradient-text {
+                background: linear-gradient(to right, #3b82f6, #8b5cf6);
+                -webkit-background-clip: text;
+                -webkit-text-fill-color: transparent;
+            }
+            /* 引导词文本颜色 - 黑色 */
+            .prompt-textarea .q-field__native {
+                color: #000000 !important;
+                font-size: 14px !important;
+                line-height: 1.5 !important;
+            }
+            .prompt-textarea .q-field__control {
+                background: white !important;
+            }
+        </style>
+    ''')
+    
+    create_header()
+    
+    # 主布局：左右分栏
+    with ui.row().classes('w-full p-4 gap-4'):
+        # 左侧区域（图片预览区，自适应宽度）
+        with ui.column().classes('flex-grow gap-3'):
+            create_left_panel()
+        
+        # 右侧区域（功能按钮区，固定宽度 320px）
+        with ui.column().classes('w-80 gap-3 flex-shrink-0'):
+            create_right_panel()
+
+
+if __name__ in {'__main__', '__mp_main__'}:
+    import argparse
+    import webbrowser
     import threading
     import time
     import socket
     
+    parser = argparse.ArgumentParser(description='优可WD14打标器')
+    parser.add_argument('--inference-server', action='store_true', help='以独立推理进程模式运行（不启动界面）')
+    parser.add_argument('--port', type=int, default=None, help='监听端口')
+    parser.add_argument('--coordinator', action='store_true', help='以分布式协调器模式运行')
+    parser.add_argument('--worker', metavar='URL', help='以 worker 模式运行，连接到指定协调器')
+    parser.add_argument('--input', help='协调器：输入图片目录；worker：本机上对应的输入目录（可选）')
+    parser.add_argument('--output', help='协调器：输出目录（默认使用界面设置）')
+    parser.add_argument('--model', nargs='+', help='协调器/精度对比：模型名称或模型文件夹路径，多个为集成模式（默认使用界面设置）')
+    parser.add_argument('--threshold', type=float, help='协调器：置信度阈值（默认使用界面设置）')
+    parser.add_argument('--profile', help='协调器：输出规则名称（config.json 中的 output_profiles）')
+    parser.add_argument('--lease-size', type=int, default=LEASE_SIZE, help='协调器：每个租约的图片数')
+    parser.add_argument('--lease-timeout', type=float, default=LEASE_TIMEOUT, help='协调器：租约超时秒数')
+    parser.add_argument('--worker-id', help='worker：自定义 worker 名称')
+    parser.add_argument('--parity', action='store_true',
+                        help='精度对比：在 --input 的图片上比较参考配置和候选配置，不在容差内时返回非零退出码')
+    parser.add_argument('--candidate-model', nargs='+', help='精度对比：候选模型名称或模型文件夹路径（默认与 --model 相同）')
+    parser.add_argument('--batch-size', type=int, help='精度对比：候选配置的批大小')
+    parser.add_argument('--threads', type=int, help='精度对比：候选配置的推理线程数（默认使用本机调优结果）')
+    parser.add_argument('--max-deviation', type=float, default=PARITY_MAX_DEVIATION, help='精度对比：最大分数偏差容差')
+    parser.add_argument('--min-jaccard', type=float, default=PARITY_MIN_JACCARD, help='精度对比：最小标签 Jaccard 容差')
+    parser.add_argument('--build-standin', metavar='DIR', help='生成用于测试的替身 ONNX 模型到指定目录')
+    args, _ = parser.parse_known_args()
+    
+    if args.inference_server:
+        authkey = os.environ.get('WD14_INFERENCE_AUTHKEY') or get_inference_server_settings()['authkey']
+        serve_inference(args.port or INFERENCE_SERVER_PORT, authkey.encode())
+        sys.exit(0)
+    
+    if args.coordinator:
+        if not args.input:
+            parser.error('--coordinator 需要指定 --input')
+        model = args.model if args.model and len(args.model) > 1 else (args.model[0] if args.model else get_last_model())
+        run_coordinator(args.input, args.output or get_output_dir(), model,
+                        get_threshold() if args.threshold is None else args.threshold,
+                        port=args.port or COORDINATOR_PORT, lease_size=args.lease_size,
+                        lease_timeout=args.lease_timeout, profile=get_output_profile(args.profile))
+        sys.exit(0)
+    
+    if args.worker:
+        run_worker(args.worker, args.worker_id, args.input)
+        sys.exit(0)
+    
+    if args.build_standin:
+        build_standin_model(args.build_standin)
+        print(f'已生成替身模型: {args.build_standin}')
+        sys.exit(0)
+    
+    if args.parity:
+        if not args.input:
+            parser.error('--parity 需要指定 --input')
+        reference_model = args.model[0] if args.model else get_last_model()
+        candidate_model = args.candidate_model or [reference_model]
+        candidate = TaggingOptions(candidate_model[0] if len(candidate_model) == 1 else candidate_model,
+                                   get_threshold() if args.threshold is None else args.threshold, '',
+                                   batch_size=args.batch_size)
+        paths = list(iter_image_files(args.input)) if os.path.isdir(args.input) else [args.input]
+        report = run_parity(paths, reference_model, candidate, args.max_deviation, args.min_jaccard, args.threads)
+        print(format_parity_report(report))
+        sys.exit(0 if report['passed'] else 1)
+    
+    if get_inference_server_settings().get('enabled'):
+        # 启动时在后台拉起推理进程，界面不必等待
+        threading.Thread(target=start_inference_server, daemon=True).start()
+    app.on_shutdown(stop_inference_server)
+    
+    catalog_settings = get_catalog_settings()
+    if catalog_settings['persist']:
+        state.catalog.attach(catalog_settings['path'])
+    
     def find_available_port(start_port, max_attempts=10):
         """查找可用端口"""
         for i in range(max_attempts):